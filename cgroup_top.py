@@ -4,7 +4,12 @@
 Monitor local cgroups as used by Docker, LXC, SystemD, ...
 
 Usage:
-  ctop [--tree] [--refresh=<seconds>] [--columns=<columns>] [--sort-col=<sort-col>] [--follow=<name>] [--fold=<cgroup>, ...]
+  ctop [--tree] [--refresh=<seconds>] [--columns=<columns>] [--sort-col=<sort-col>] [--follow=<name>] [--fold=<cgroup>, ...] [--root=<cgroup>] [--psi-alert] [--cpu-budget=<percent>] [--hide-self]
+  ctop --agent --listen=<address> [--refresh=<seconds>]
+  ctop --rules=<file> [--rules-hook=<command>] [--refresh=<seconds>]
+  ctop --connect=<address>,... [--tree] [--columns=<columns>] [--sort-col=<sort-col>]
+  ctop --snapshot=<file> [--refresh=<seconds>]
+  ctop diff <before> <after> [--sort-col=<sort-col>] [--rows=<count>]
   ctop (-h | --help)
 
 Options:
@@ -15,6 +20,20 @@ Options:
   --columns=<columns>    List of optional columns to display. Always includes 'name'. [default: owner,processes,memory,cpu-sys,cpu-user,blkio,cpu-time].
   --sort-col=<sort-col>  Select column to sort by initially. Can be changed dynamically. [default: cpu-user]
   --type=[types]         Only keep containers of this types
+  --root=<cgroup>        Only monitor the cgroup sub-tree at this path [default: /].
+  --cpu-budget=<percent> Keep collection under <percent> of one CPU, refreshing the hottest cgroups and a rotating slice of the others.
+  --hide-self            Do not monitor the cgroups ctop runs in.
+  --psi-alert            Highlight cgroups as soon as the kernel reports a pressure stall (cgroup v2 only).
+  --agent                Do not display anything, stream samples to 'ctop --connect' clients.
+  --listen=<address>     Agent address, either <host>:<port> or a unix socket path.
+  --connect=<addresses>  Display samples from a comma separated list of agents, grouped by host.
+  --rules=<file>         Do not display anything, print alerts as JSON lines when rules from <file> fire or resolve.
+  --rules-hook=<command> Run <command> on alerts instead, with CTOP_RULE, CTOP_CGROUP, CTOP_STATE and CTOP_TIME set.
+  --snapshot=<file>      Do not display anything, save figures averaged over <seconds> to <file>, for 'ctop diff'.
+  --rows=<count>         Only list the <count> largest changes with 'ctop diff', 0 for all [default: 50].
+  --export-folded=<file> Write CPU time per cgroup to <file> in folded stack format, for flamegraph tools.
+  --plugin=<file>        Load columns and collectors from plugin <file>, see 'register'.
+  --mounts=<file>        Read cgroup mountpoints from <file> [default: /proc/mounts].
   -h --help              Show this screen.
 
 '''
@@ -31,9 +50,20 @@ import errno
 import subprocess
 import multiprocessing
 import json
+import array
+import operator
+import bisect
+import heapq
+import select
+import signal
+import struct
+import random
+import socket
 
 from collections import defaultdict
+from collections import deque
 from collections import namedtuple
+from resource import getrlimit, RLIMIT_NOFILE, RLIM_INFINITY
 
 from optparse import OptionParser
 
@@ -44,6 +74,18 @@ except ImportError:
     print("Curse is not available on this system. Exiting.", file=sys.stderr)
     sys.exit(0)
 
+# Python >= 3.3
+monotonic = getattr(time, 'monotonic', time.time)
+process_time = getattr(time, 'process_time', lambda: sum(os.times()[:2]))
+
+# Optional: used for inotify based cgroup discovery
+try:
+    import ctypes, ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    libc.inotify_init1
+except (ImportError, OSError, AttributeError):
+    libc = None
+
 def cmd_exists(cmd):
     try:
         return subprocess.call(["which",  cmd], stdout=subprocess.PIPE, stderr=subprocess.PIPE) == 0
@@ -59,6 +101,11 @@ HAS_LIBVIRT = cmd_exists('virsh')
 
 HIDE_EMPTY_CGROUP = True
 CGROUP_MOUNTPOINTS={}
+CGROUP_DISCOVERY={}
+# Refresh counter, bumped by ``collect``. Keys caches valid for one refresh.
+TICK = {'count': 0}
+# 'pids.current' counters read on this refresh, see ``pids_current``
+PIDS_CURRENT = {'tick': None, 'values': {}}
 CONFIGURATION = {
         'sort_by': 'cpu_total',
         'sort_asc': False,
@@ -74,26 +121,196 @@ CONFIGURATION = {
         'cgroups': [],
         'fold': [],
         'type': [],
+        'psi_alert': False,
+        'alerts': {},
+        'remotes': [],
+        'details': False,
+        'root': '/',
+        'search': '',
+        'search_regex': None,
+        'searching': False,
+        'aggregate': False,
+        'cpu_budget': None,
+        'hide_self': False,
+        'self': set(),
+        'notify': False,
+        'export_folded': None,
 }
 
-Column = namedtuple('Column', ['title', 'width', 'align', 'col_fmt', 'col_data', 'col_sort'])
+Column = namedtuple('Column', ['title', 'width', 'align', 'col_fmt', 'col_data', 'col_sort', 'col_deps'])
+Plugin = namedtuple('Plugin', ['name', 'hierarchies', 'parse', 'compute', 'details', 'with_cgroup'])
+Rule = namedtuple('Rule', ['name', 'field', 'reference', 'op', 'threshold', 'hold_threshold', 'fire', 'hold', 'duration'])
+RuleComparison = namedtuple('RuleComparison', ['op', 'numbers', 'thresholds', 'holds', 'tests'])
+RuleGroup = namedtuple('RuleGroup', ['field', 'reference', 'comparisons', 'floor', 'ceiling'])
 
 COLUMNS = []
 COLUMNS_MANDATORY = ['name']
+# More columns are added by plugins, see ``register``
 COLUMNS_AVAILABLE = {
-    'owner':     Column("OWNER",   10, '<', '{0:%ss}',      'owner',           'owner'),
-    'type':      Column("TYPE",    10, '<', '{0:%ss}',      'type',            'type'),
-    'processes': Column("PROC",    11, '>', '{0:%ss}',      'tasks',           'tasks'),
-    'memory':    Column("MEMORY",  17, '^', '{0:%ss}',      'memory_cur_str',  'memory_cur_bytes'),
-    'cpu-sys':   Column("SYST",     5, '^', '{0: >%s.1%%}', 'cpu_syst',        'cpu_total'),
-    'cpu-user':  Column("USER",     5, '^', '{0: >%s.1%%}', 'cpu_user',        'cpu_total'),
-    'blkio':     Column("BLKIO",   10, '^', '{0: >%s}',     'blkio_bw',        'blkio_bw_bytes'),
-    'cpu-time':  Column("TIME+",   14, '^', '{0: >%ss}',    'cpu_total_str',   'cpu_total_seconds'),
-    'name':      Column("CGROUP",  '', '<', '{0:%ss}',      'cgroup',          'cgroup'),
+    'owner':     Column("OWNER",   10, '<', '{0:%ss}',      'owner',           'owner',             ()),
+    'type':      Column("TYPE",    10, '<', '{0:%ss}',      'type',            'type',              ()),
+    'processes': Column("PROC/THREADS", 17, '>', '{0:%ss}', 'tasks',          'tasks',             ('tasks', 'pids.max')),
+    'memory':    Column("MEMORY",  17, '^', '{0:%ss}',      'memory_cur_str',  'memory_cur_bytes',  ('memory.usage_in_bytes', 'memory.stat', 'memory.limit_in_bytes')),
+    'cpu-sys':   Column("SYST",     5, '^', '{0: >%s.1%%}', 'cpu_syst',        'cpu_total',         ('cpuacct.usage_user', 'cpuacct.usage_sys')),
+    'cpu-user':  Column("USER",     5, '^', '{0: >%s.1%%}', 'cpu_user',        'cpu_total',         ('cpuacct.usage_user', 'cpuacct.usage_sys')),
+    'blkio':     Column("BLKIO",   10, '^', '{0: >%s}',     'blkio_bw',        'blkio_bw_bytes',    ('blkio.throttle.io_service_bytes',)),
+    'blkio-read':  Column("READ",  10, '^', '{0: >%s}',     'blkio_read_bw',   'blkio_read_bytes',  ('blkio.throttle.io_service_bytes',)),
+    'blkio-write': Column("WRITE", 10, '^', '{0: >%s}',     'blkio_write_bw',  'blkio_write_bytes', ('blkio.throttle.io_service_bytes',)),
+    'iops-read':   Column("R-IOPS", 7, '^', '{0: >%s.0f}',  'blkio_read_iops', 'blkio_read_iops',   ('blkio.throttle.io_serviced',)),
+    'iops-write':  Column("W-IOPS", 7, '^', '{0: >%s.0f}',  'blkio_write_iops', 'blkio_write_iops', ('blkio.throttle.io_serviced',)),
+    'cpu-imbalance': Column("IMBAL", 6, '^', '{0: >%s.0%%}', 'cpu_imbalance',  'cpu_imbalance',     ('cpuacct.usage_percpu', 'cpuacct.usage_user', 'cpuacct.usage_sys')),
+    'numa-remote': Column("REMOTE", 6, '^', '{0: >%s.0%%}',  'memory_remote',  'memory_remote',     ('memory.numa_stat',)),
+    'cpu-time':  Column("TIME+",   14, '^', '{0: >%ss}',    'cpu_total_str',   'cpu_total_seconds', ('cpuacct.usage_user', 'cpuacct.usage_sys')),
+    'age':       Column("AGE",      5, '>', '{0: >%s.1f}',  'age',             'age',               ()),
+    'oom':       Column("OOM/LIMIT", 11, '>', '{0: >%ss}',   'memory_events',   'oom_kills',         ('memory.oom_control',)),
+    'host':      Column("HOST",    12, '<', '{0:%ss}',      'host',            'host',              ()),
+    'name':      Column("CGROUP",  '', '<', '{0:%ss}',      'cgroup',          'cgroup',            ()),
+}
+
+# Metric collectors, see ``register``. Also loaded from this entry point group.
+PLUGINS = []
+PLUGIN_ENTRY_POINTS = 'ctop.plugins'
+
+# Figures summed over sub-trees by ``rollup``. cpuacct and memory usages, as
+# well as cgroup v2 'io.stat', already include descendants in the kernel.
+ROLLUP_FIELDS = ['cur_procs', 'cur_tasks']
+ROLLUP_FIELDS_BLKIO = ['blkio_bw_bytes', 'blkio_read_bytes', 'blkio_write_bytes', 'blkio_read_iops', 'blkio_write_iops']
+ROLLUP = {'results': None}
+
+# Drill-down pane height, title included
+DETAILS_HEIGHT = 10
+
+# Per CPU usage heatmap, from idle to busy, and per NUMA node memory are
+# drawn right of the drill-down pane devices
+HEATMAP_SHADES = '.:-=+*#%@'
+DETAILS_SIDE_X = 56
+
+# Controller files to read on each refresh. Derived from the visible columns,
+# the sort column and the enabled features by ``rebuild_read_plan``.
+READ_PLAN = set()
+
+# CPU budget mode, see ``plan_budget``. Share of the cgroups read on each
+# refresh that goes to the hottest ones, the others are read in turn. Reads
+# are planned for this share of the budget, as their cost varies from one
+# refresh to the next.
+BUDGET_HOT_SHARE = 0.5
+BUDGET_PLANNED_SHARE = 0.9
+BUDGET = {
+    'cost': None,       # CPU seconds per cgroup read, smoothed
+    'fixed': 0.0,       # CPU seconds per refresh spent listing cgroups, smoothed
+    'listing': 0.0,     # CPU seconds spent listing cgroups on this refresh
+    'skip': set(),      # cgroup paths not to read on this refresh
+    'skipped': set(),   # cgroup paths found but not read on this refresh
+}
+
+# Folded stack export of CPU time, see ``accumulate_folded``. Past this many
+# cgroups, the smallest are merged into their parents. Rewritten this often
+# (seconds) during capture.
+FOLDED_MAX_STACKS = 20000
+FOLDED_WRITE_INTERVAL = 10.0
+FOLDED = {
+    'stacks': defaultdict(int),  # cgroup path -> CPU ns, children excluded
+    'written': 0,
 }
 
 DOCKER_PREFIXES = ["/docker/", "/system.slice/docker-", "/system.slice/docker/"]
 
+# cpuacct.stat counts USER_HZ ticks
+TICKS_TO_NS = 1e9 / os.sysconf('SC_CLK_TCK')
+
+# Rules, see ``compile_rule``
+RULE_REGEXP = re.compile(r'^(?:(?P<name>[\w.-]+):\s*)?(?P<field>[\w.]+)\s+(?P<op>>=|<=|==|!=|>|<|near)\s+(?P<reference>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|[\w.]+)(?:\s+for\s+(?P<duration>\d+(?:\.\d+)?)(?P<unit>[smh]?))?\s*$')
+RULE_FLIPPED = {'>': '<', '>=': '<=', '<': '>', '<=': '>='}
+RULE_NO_SPAN = (0, 0, 0, 0)
+RULE_NO_MATCH = (None, None, None)
+RULE_OPERATORS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le, '==': operator.eq, '!=': operator.ne, 'near': operator.ge}
+RULE_ALIASES = {'tasks': 'cur_tasks', 'procs': 'cur_procs', 'pids.current': 'tree_tasks', 'pids.max': 'max_tasks', 'memory': 'memory_cur_bytes', 'memory.limit': 'memory_limit_bytes'}
+RULE_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600}
+RULE_NEAR = 0.9         # 'a near b' fires when a reaches 90% of b
+RULE_HYSTERESIS = 0.05  # fired rules resolve 5% below their threshold
+try:
+    NUMBERS = (int, long, float)
+except NameError:
+    NUMBERS = (int, float)
+
+# Agent mode
+AGENT_PORT = 5005
+# Agents send without blocking, dropping clients which fall this many bytes
+# behind, on top of the initial state
+AGENT_BACKLOG = 16 << 20
+AGENT_SEND_SIZE = 1 << 16
+# Clients connect to agents in the background, giving up after this long,
+# and retry unreachable agents with an exponential backoff (seconds)
+AGENT_CONNECT_TIMEOUT = 5.0
+AGENT_RETRY_MIN = 1.0
+AGENT_RETRY_MAX = 30.0
+
+# Per CPU and per NUMA node figures, too large to stream or save for every
+# cgroup. Their summaries are kept.
+BULKY_FIELDS = ['cpu_percpu', 'memory_numa']
+
+# Snapshot diff: (title, width, parse, format of the change), in snapshot order
+DIFF_COLUMNS = [
+    ('CPU',    8, float, lambda delta: '{0:+.1%}'.format(delta)),
+    ('MEMORY', 9, int, lambda delta: ('+' if delta >= 0 else '') + to_human(delta)),
+    ('BLKIO', 11, float, lambda delta: ('+' if delta >= 0 else '') + to_human(delta, 'B/s')),
+    ('THREADS', 7, int, lambda delta: '{0:+d}'.format(delta)),
+]
+DIFF_SORT = {'cpu_total': 0, 'memory_cur_bytes': 1, 'blkio_bw_bytes': 2, 'tasks': 3}
+
+# Errors when reading a cgroup removed since last discovery
+VANISHED = (errno.ENOENT, errno.ENODEV)
+
+# inotify, see <sys/inotify.h>
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# Full rescan period when inotify is not usable (seconds)
+DISCOVERY_RESCAN_INTERVAL = 5.0
+
+# Empty cgroups are re-checked for tasks at this period only (seconds), give or
+# take half of it so that rechecks do not all fall on the same refresh
+EMPTY_RECHECK_INTERVAL = 5.0
+
+# NUMA nodes of cgroup cpusets are cached, and re-read at this period only
+# (seconds) give or take half of it, as cpusets can be changed in place
+CPUSET_RECHECK_INTERVAL = 30.0
+
+# Pressure Stall Information. Triggers wake us up when tasks of a cgroup stalled
+# for more than 150ms over a 1s window, see Documentation/accounting/psi.rst
+PRESSURE_RESOURCES = ['cpu', 'memory', 'io']
+PSI_TRIGGER = "some 150000 1000000"
+ALERT_TIMEOUT = 5.0
+
+# Kernel notifications we are waiting for, next to curses input. Each one holds
+# a file descriptor, they may use this share of the open files limit. Cgroups
+# past it are polled on each refresh instead.
+WATCH_FD_SHARE = 0.5
+EVENTS = {
+    'poll': None,      # epoll object, created on first watch
+    'watches': {},     # fd -> (kind, cgroup name, watched file path)
+    'paths': {},       # watched file path -> (kind, fd, cgroup name), fd is None if watch failed
+    'capacity': None,  # maximum number of watches
+    'refreshed': 0,    # last refresh triggered by a memory event
+}
+
+# Memory events. cgroup v1 notifies through eventfds registered in
+# 'cgroup.event_control' for OOMs and usage thresholds, set close to the
+# limit. cgroup v2 wakes pollers of 'memory.events' when its counters change.
+# Event triggered refreshes are at most this frequent (seconds).
+MEMORY_THRESHOLD = 0.95
+MEMORY_EVENT_KINDS = ['oom', 'threshold', 'memory.events']
+MEMORY_EVENT_REFRESH = 0.5
+EFD_CLOEXEC = 0o2000000
+EFD_NONBLOCK = 0o4000
+
 # TODO:
 # - visual CPU/memory usage
 # - auto-color
@@ -176,7 +393,7 @@ def to_human(num, suffix='B'):
     return "{0:5.1d}{1}{2}" % (num, 'Y', suffix)
 
 def div(num, by):
-    res = num / by
+    res = num // by
     mod = num % by
     return res, mod
 
@@ -189,6 +406,150 @@ def to_human_time(seconds):
     else:
         return '%02d:%02d.%02d' % (hours, minutes, seconds)
 
+def parse_pressure(content):
+    '''
+    Parse a PSI file into a dict like
+    ``{'some': {'avg10': 0.0, 'avg60': 0.0, 'avg300': 0.0, 'total': 0}, ...}``
+    '''
+    pressure = {}
+    for line in content.strip().split('\n'):
+        kind, values = line.split(' ', 1)
+        pressure[kind] = dict(v.split('=', 1) for v in values.split())
+        for k, v in pressure[kind].items():
+            pressure[kind][k] = float(v)
+    return pressure
+
+def parse_blkio(content):
+    '''
+    Single pass parser for 'blkio.throttle.io_service*' files. Return
+    ``({'major:minor': [read, write]}, total)``
+    '''
+    devices = {}
+    total = 0
+    for line in content.split('\n'):
+        fields = line.split()
+        if len(fields) == 3:
+            if fields[1] == 'Read':
+                devices.setdefault(fields[0], [0, 0])[0] = int(fields[2])
+            elif fields[1] == 'Write':
+                devices.setdefault(fields[0], [0, 0])[1] = int(fields[2])
+        elif len(fields) == 2 and fields[0] == 'Total':
+            total = int(fields[1])
+    return devices, total
+
+def parse_io_stat(content):
+    '''
+    Parse cgroup v2 'io.stat' into ``{'major:minor': [rbytes, wbytes, rios, wios]}``
+    '''
+    devices = {}
+    for line in content.split('\n'):
+        fields = line.split()
+        if not fields:
+            continue
+        stats = dict(field.split('=', 1) for field in fields[1:])
+        devices[fields[0]] = [int(stats.get(key, 0)) for key in ('rbytes', 'wbytes', 'rios', 'wios')]
+    return devices
+
+def parse_numa_stat(content, page_size):
+    '''
+    Parse 'memory.numa_stat' into {node: bytes}. cgroup v1 counts pages,
+    sub-tree included in 'hierarchical_total', v2 counts bytes per memory
+    type.
+    '''
+    nodes = defaultdict(int)
+    totals = {}
+    for line in content.strip().split('\n'):
+        fields = line.split()
+        key = fields[0].split('=')[0]
+        if key in ('total', 'hierarchical_total'):
+            totals[key] = dict((int(node[1:]), int(value) * page_size) for node, value in (field.split('=') for field in fields[1:]))
+        elif key in ('anon', 'file'):
+            for node, value in (field.split('=') for field in fields[1:]):
+                nodes[int(node[1:])] += int(value)
+    return totals.get('hierarchical_total', totals.get('total', dict(nodes)))
+
+def parse_cpu_list(content):
+    '''
+    Parse a CPU or node list like '0-3,8-11' into a set
+    '''
+    cpus = set()
+    for item in content.strip().split(','):
+        if '-' in item:
+            first, last = item.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        elif item:
+            cpus.add(int(item))
+    return cpus
+
+def get_cpu_nodes(path='/sys/devices/system/node', cache=dict()):
+    '''
+    Map each CPU to its NUMA node. Empty when the kernel has no NUMA support.
+    '''
+    if path in cache:
+        return cache[path]
+
+    cpu_nodes = cache[path] = {}
+    try:
+        nodes = [name for name in os.listdir(path) if re.match(r'^node\d+$', name)]
+    except OSError:
+        return cpu_nodes
+
+    for node in nodes:
+        with open(os.path.join(path, node, 'cpulist')) as f:
+            for cpu in parse_cpu_list(f.read()):
+                cpu_nodes[cpu] = int(node[4:])
+    return cpu_nodes
+
+def cpuset_nodes(short_path, cpu_nodes):
+    '''
+    NUMA nodes of the CPUs cgroup ``short_path`` may run on, from its closest
+    cpuset. None when unknown.
+    '''
+    if 'cpuset' in CGROUP_MOUNTPOINTS:
+        base_path, name = CGROUP_MOUNTPOINTS['cpuset'], 'cpuset.cpus'
+    elif 'unified' in CGROUP_MOUNTPOINTS:
+        base_path, name = CGROUP_MOUNTPOINTS['unified'], 'cpuset.cpus.effective'
+    else:
+        return None
+
+    # Not all cgroups are in the cpuset hierarchy
+    while True:
+        try:
+            with open(os.path.join(base_path, short_path.lstrip('/'), name)) as f:
+                cpus = parse_cpu_list(f.read())
+            if cpus:
+                return set(cpu_nodes[cpu] for cpu in cpus if cpu in cpu_nodes)
+        except IOError as e:
+            if e.errno not in VANISHED:
+                raise
+        if short_path == '/':
+            return None
+        short_path = os.path.dirname(short_path)
+
+def block_device_name(device, cache=dict()):
+    '''
+    Resolve a 'major:minor' block device number to its kernel name, like 'sda'
+    '''
+    if device not in cache:
+        try:
+            cache[device] = os.path.basename(os.readlink('/sys/dev/block/' + device))
+        except OSError:
+            cache[device] = device
+    return cache[device]
+
+def own_cgroups(path='/proc/self/cgroup'):
+    '''
+    Paths of the cgroups ctop itself runs in, one per hierarchy. The root
+    cgroup is not one of them, it holds everything.
+    '''
+    try:
+        with open(path) as f:
+            paths = set(line.split(':', 2)[2] for line in f.read().strip().split('\n'))
+    except IOError:
+        return set()
+    paths.discard('/')
+    return paths
+
 def get_total_memory():
     '''
     Get total memory from /proc if available.
@@ -270,9 +631,16 @@ class Cgroup(object):
 
         return self.short_path
 
+    @property
+    def tasks_file(self):
+        # cgroup v2 has no 'tasks' file, 'cgroup.threads' is the equivalent
+        if self.base_path == CGROUP_MOUNTPOINTS.get('unified'):
+            return 'cgroup.threads'
+        return 'tasks'
+
     @property
     def owner(self):
-        path = os.path.join(self.base_path, self.path, 'tasks')
+        path = os.path.join(self.base_path, self.path, self.tasks_file)
         uid = os.stat(path).st_uid
         try:
             return pwd.getpwuid(uid).pw_name
@@ -316,13 +684,17 @@ class Cgroup(object):
 
         return value
 
-    def __getitem__(self, name):
-        path = os.path.join(self.base_path, self.path, name)
+    def read(self, name):
+        '''
+        Raw content of controller file ``name``
+        '''
+        with open(os.path.join(self.base_path, self.path, name)) as f:
+            return f.read()
 
-        with open(path) as f:
-            content = f.read().strip()
+    def __getitem__(self, name):
+        content = self.read(name).strip()
 
-        if name == 'tasks' or '\n' in content or ' ' in content:
+        if name in ('tasks', 'cgroup.threads') or '\n' in content or ' ' in content:
             content = content.split('\n')
 
             if ' ' in content[0]:
@@ -337,16 +709,586 @@ class Cgroup(object):
 
         return content
 
+class CgroupDiscovery(object):
+    '''
+    Keep track of cgroup directories under ``base_path``, limited to the
+    ``root`` sub-tree. Walk the hierarchy once, then follow creations and
+    removals with inotify. Fall back to periodic full rescans when inotify is
+    not available or runs out of watches.
+    '''
+    def __init__(self, base_path, root='/'):
+        self.base_path = base_path
+        self.top = os.path.normpath(os.path.join(base_path, root.lstrip('/')))
+        self.paths = set()
+        self.children = defaultdict(set)    # path -> child paths
+        self.watches = {}   # wd -> path
+        self.wds = {}       # path -> wd
+        self.fd = None
+        self.exhausted = False
+        self.last_scan = 0
+        self.empty = {}     # path -> next population check time
+        self.unified = base_path == CGROUP_MOUNTPOINTS.get('unified')
+        self.search_regex = None
+        self.search_index = {}  # path -> matches search_regex
+        self.tick = None
+        self.listed = set()     # paths to collect on refresh ``tick``
+        self.cpusets = {}       # path -> (NUMA nodes, next check time)
+
+        if libc is not None:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self.fd = fd
+
+        self.rescan()
+
+    def rescan(self):
+        self.paths = set()
+        self.children = defaultdict(set)
+        self.last_scan = time.time()
+        for cgroup_path, dirs, files in os.walk(self.top):
+            self.add(cgroup_path)
+        self.search_index = {}
+        for path in [path for path in self.empty if path not in self.paths]:
+            del self.empty[path]
+        for path in [path for path in self.cpusets if path not in self.paths]:
+            del self.cpusets[path]
+
+    def add(self, path):
+        self.paths.add(path)
+        if path != self.top:
+            self.children[os.path.dirname(path)].add(path)
+        if self.fd is None or self.exhausted:
+            return
+
+        encoded = path if isinstance(path, bytes) else path.encode(sys.getfilesystemencoding())
+        wd = libc.inotify_add_watch(self.fd, encoded, IN_CREATE | IN_DELETE | IN_ONLYDIR)
+        if wd >= 0:
+            self.watches[wd] = path
+            self.wds[path] = wd
+        elif ctypes.get_errno() == errno.ENOSPC:
+            # Out of watches (fs.inotify.max_user_watches)
+            self.exhausted = True
+        elif ctypes.get_errno() in VANISHED:
+            self.discard(path)
+
+    def discard(self, path):
+        self.paths.discard(path)
+        self.children[os.path.dirname(path)].discard(path)
+        self.children.pop(path, None)
+
+    def update(self):
+        '''
+        Apply pending creations and removals, rescan if needed
+        '''
+        if self.fd is None or self.exhausted:
+            if time.time() - self.last_scan >= DISCOVERY_RESCAN_INTERVAL:
+                self.rescan()
+            if self.fd is None:
+                return
+
+        while True:
+            try:
+                events = os.read(self.fd, 64 * 1024)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+
+            offset = 0
+            while offset < len(events):
+                wd, mask, _cookie, length = INOTIFY_EVENT.unpack_from(events, offset)
+                offset += INOTIFY_EVENT.size
+                name = events[offset:offset+length].rstrip(b'\0')
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost
+                    self.rescan()
+                elif mask & IN_IGNORED:
+                    self.wds.pop(self.watches.pop(wd, None), None)
+                elif mask & IN_ISDIR and wd in self.watches:
+                    if not isinstance(name, str):
+                        name = name.decode(sys.getfilesystemencoding(), 'surrogateescape')
+                    path = os.path.join(self.watches[wd], name)
+
+                    # Sub-cgroups may have been created before the watch
+                    if mask & IN_CREATE:
+                        for cgroup_path, dirs, files in os.walk(path):
+                            self.add(cgroup_path)
+                    # A cgroup can only be removed once it has no children
+                    elif mask & IN_DELETE:
+                        self.discard(path)
+                        self.empty.pop(path, None)
+                        self.search_index.pop(path, None)
+                        self.cpusets.pop(path, None)
+                        if path in self.wds:
+                            libc.inotify_rm_watch(self.fd, self.wds[path])
+                            del self.watches[self.wds.pop(path)]
+
+    def cpuset_nodes(self, cgroup, cpu_nodes):
+        '''
+        Cached ``cpuset_nodes`` of ``cgroup``, dropped with the cgroup
+        '''
+        now = time.time()
+        nodes, expires = self.cpusets.get(cgroup.path, (None, 0))
+        if expires <= now:
+            nodes = cpuset_nodes(cgroup.short_path, cpu_nodes)
+            self.cpusets[cgroup.path] = (nodes, now + CPUSET_RECHECK_INTERVAL * random.uniform(0.5, 1.5))
+        return nodes
+
+    def has_tasks(self, path):
+        '''
+        Cheap population check: v2 reports it for the whole sub-tree in
+        'cgroup.events', v1 needs at least one byte in 'cgroup.procs'.
+        '''
+        try:
+            if self.unified:
+                with open(os.path.join(path, 'cgroup.events')) as f:
+                    return 'populated 1' in f.read()
+            with open(os.path.join(path, 'cgroup.procs')) as f:
+                return bool(f.read(1))
+        except IOError as e:
+            if e.errno in VANISHED:
+                return False
+            raise
+
+    def matching(self):
+        '''
+        Return the paths matching the incremental search, and their parents.
+        Matching is done on the full path, so the sub-tree of a match matches
+        too. Results are indexed until the search changes.
+        '''
+        regex = CONFIGURATION['search_regex']
+        if regex is None:
+            return self.paths
+
+        if regex is not self.search_regex:
+            self.search_regex = regex
+            self.search_index = {}
+
+        selected = set([self.top])
+        for path in self.paths:
+            if path not in self.search_index:
+                self.search_index[path] = bool(regex.search(path[len(self.base_path):]))
+            if not self.search_index[path]:
+                continue
+
+            while path not in selected:
+                selected.add(path)
+                path = os.path.dirname(path)
+
+        return selected
+
+    def listing(self, tick, skip=()):
+        '''
+        Return (paths to collect, paths skipped) on refresh ``tick``.
+        Discovery updates, search and population checks run once per refresh,
+        however many passes are made over this hierarchy. Cgroups in ``skip``,
+        short paths, are not even checked for tasks.
+        '''
+        if tick != self.tick:
+            self.tick = tick
+            self.update()
+            paths = self.matching()
+            skipped = set(path for path in paths if (path[len(self.base_path):] or '/') in skip) if skip else set()
+            if HIDE_EMPTY_CGROUP:
+                paths = self.populated(paths - skipped, skipped)
+            self.listed = (paths - skipped, skipped)
+        return self.listed
+
+    def populated(self, paths, known=()):
+        '''
+        Return the ``paths`` of cgroups with at least one task in their
+        sub-tree. Empty cgroups are skipped until their next check. Cgroups
+        in ``known`` are not checked, their parents are populated unless they
+        were last found empty.
+        '''
+        now = time.time()
+        populated = set([self.top])
+
+        for path in known:
+            if path in self.empty:
+                continue
+            while path not in populated:
+                populated.add(path)
+                path = os.path.dirname(path)
+
+        for path in paths:
+            if path in populated or self.empty.get(path, 0) > now:
+                continue
+
+            if not self.has_tasks(path):
+                self.empty[path] = now + EMPTY_RECHECK_INTERVAL * random.uniform(0.5, 1.5)
+                continue
+            self.empty.pop(path, None)
+
+            # A cgroup is populated if any of its children is
+            while path not in populated:
+                populated.add(path)
+                path = os.path.dirname(path)
+
+        return populated
+
 def cgroups(base_path):
     '''
     Generator of cgroups under path ``name``
     '''
-    for cgroup_path, dirs, files in os.walk(base_path):
+    if base_path not in CGROUP_DISCOVERY:
+        CGROUP_DISCOVERY[base_path] = CgroupDiscovery(base_path, CONFIGURATION['root'])
+
+    # Listing is a fixed cost per refresh, see ``plan_budget``
+    start = process_time()
+    paths, skipped = CGROUP_DISCOVERY[base_path].listing(TICK['count'], BUDGET['skip'])
+    BUDGET['skipped'].update(path[len(base_path):] or '/' for path in skipped)
+    BUDGET['listing'] += process_time() - start
+
+    for cgroup_path in paths:
+        short_path = cgroup_path[len(base_path):] or '/'
+        if CONFIGURATION['hide_self'] and short_path in CONFIGURATION['self']:
+            continue
         yield Cgroup(cgroup_path, base_path)
 
+## Plugins
+
+def register(name, hierarchies, parse, compute, columns=None, details=False, with_cgroup=False):
+    '''
+    Register metric collector ``name``. ``hierarchies`` lists (controller,
+    files) pairs, the files of the first mounted controller are read, 'unified'
+    being cgroup v2. A controller may be listed more than once, for older
+    kernels: the first files found in its root cgroup are read, else the last
+    ones. ``columns`` maps new column names to ``Column`` fields.
+
+    Files are read on each refresh, as long as one of the files of the first
+    pair is needed by a visible or sort column. With ``details``, they are
+    otherwise read for the cgroup of the drill-down pane only.
+
+    ``parse(contents, prev)`` turns each cgroup {file: content} into a value,
+    given the previous value, if any. It runs right after the files are read,
+    for rates to be timestamped there. With ``with_cgroup``, it is also given
+    the ``Cgroup``, for figures that do not only depend on its own files. Then
+    ``compute(line, value, system)`` adds figures to each sample ``line``,
+    with ``value`` None when nothing was read, in registration order.
+    ``system`` holds host wide figures like 'total_cpu' and 'total_memory'.
+
+    Parsed values are kept per cgroup only: a plugin cannot see other cgroups,
+    nor register kernel notifications. Those stay in ``collect``.
+    '''
+    PLUGINS.append(Plugin(name, hierarchies, parse, compute, details, with_cgroup))
+    for column_name, column in (columns or {}).items():
+        COLUMNS_AVAILABLE[column_name] = Column(*column)
+
+def plan_plugins():
+    '''
+    Group plugins needed on this refresh by mountpoint, so that each
+    hierarchy is walked once for all of them. Plugins only needed by the
+    drill-down pane come with the name of its cgroup.
+    '''
+    selected = CONFIGURATION['selected_line_name'] if CONFIGURATION['details'] else None
+    plan = defaultdict(list)
+    for plugin in PLUGINS:
+        if any(name in READ_PLAN for name in plugin.hierarchies[0][1]):
+            only = None
+        elif plugin.details and selected is not None:
+            only = selected
+        else:
+            continue
+
+        for index, (controller, files) in enumerate(plugin.hierarchies):
+            if controller not in CGROUP_MOUNTPOINTS:
+                continue
+            mountpoint = CGROUP_MOUNTPOINTS[controller]
+            fallback = any(other == controller for other, _ in plugin.hierarchies[index+1:])
+            if fallback and not os.path.exists(os.path.join(mountpoint, files[0])):
+                continue
+            plan[mountpoint].append((plugin, files, only))
+            break
+    return plan
+
+def collect_plugins(plugins, data, prev, cgroup):
+    '''
+    Read the files of ``plugins`` from ``cgroup``, each file once, and store
+    parsed values in ``data``
+    '''
+    contents = {}
+    for plugin, files, only in plugins:
+        if only is not None and cgroup.name != only:
+            continue
+        try:
+            for name in files:
+                if name not in contents:
+                    contents[name] = cgroup.read(name)
+        except (IOError, OSError) as e:
+            # Missing on the root cgroup, controller not enabled, PSI
+            # disabled (psi=0) or cgroup removed
+            if e.errno in VANISHED + (errno.EOPNOTSUPP,):
+                continue
+            raise
+        if plugin.with_cgroup:
+            data[plugin.name] = plugin.parse(contents, prev.get(plugin.name), cgroup)
+        else:
+            data[plugin.name] = plugin.parse(contents, prev.get(plugin.name))
+
+def entry_points(group):
+    '''
+    Installed entry points of ``group``. Empty when setuptools is missing on
+    Python < 3.8.
+    '''
+    try:
+        from importlib.metadata import entry_points as all_entry_points
+    except ImportError:
+        try:
+            import pkg_resources
+        except ImportError:
+            return []
+        return list(pkg_resources.iter_entry_points(group))
+
+    found = all_entry_points()
+    if hasattr(found, 'select'):
+        return list(found.select(group=group))
+    return list(found.get(group, []))
+
+def load_plugins(paths):
+    '''
+    Load installed plugins, then plugin files ``paths``. Plugins provide a
+    ``setup(register)`` function, calling ``register`` for each collector.
+    '''
+    for entry_point in entry_points(PLUGIN_ENTRY_POINTS):
+        entry_point.load()(register)
+
+    for path in paths:
+        namespace = {'__file__': path, '__name__': 'ctop_plugin'}
+        with open(path) as f:
+            exec(compile(f.read(), path, 'exec'), namespace)
+        if not callable(namespace.get('setup')):
+            raise ValueError("%s: no setup(register) function" % path)
+        namespace['setup'](register)
+
+# Built-in plugins
+
+def parse_cpu(contents, prev):
+    '''
+    User and system CPU time, in nanoseconds. Prefer nanosecond counters over
+    USER_HZ ticks.
+    '''
+    if 'cpu.stat' in contents:
+        cpu_stat = dict((key, int(value)) for key, value in (line.split() for line in contents['cpu.stat'].strip().split('\n')))
+        usage = {'user': cpu_stat['user_usec'] * 1000, 'system': cpu_stat['system_usec'] * 1000}
+    elif 'cpuacct.usage_user' in contents:
+        usage = {'user': int(contents['cpuacct.usage_user']), 'system': int(contents['cpuacct.usage_sys'])}
+    else:
+        cpu_stat = dict((key, int(value)) for key, value in (line.split() for line in contents['cpuacct.stat'].strip().split('\n')))
+        usage = {'user': cpu_stat['user'] * TICKS_TO_NS, 'system': cpu_stat['system'] * TICKS_TO_NS}
+
+    value = {'usage': usage, 'time': monotonic()}
+    if prev is not None:
+        value['diff'] = dict((key, used - prev['usage'][key]) for key, used in usage.items())
+        value['elapsed'] = value['time'] - prev['time']
+    return value
+
+def compute_cpu(line, value, system):
+    usage = (value or {}).get('usage', {})
+    line['cpu_total_seconds'] = (usage.get('system', 0) + usage.get('user', 0)) / 1e9
+    line['cpu_syst'] = line['cpu_user'] = 0.0
+    if 'diff' in (value or {}):
+        cpu_to_percent = 1e9 * system['total_cpu'] * value['elapsed']
+        line['cpu_syst'] = value['diff']['system'] / cpu_to_percent
+        line['cpu_user'] = value['diff']['user'] / cpu_to_percent
+
+register('cpu', [('cpuacct', ['cpuacct.usage_user', 'cpuacct.usage_sys']), ('cpuacct', ['cpuacct.stat']), ('unified', ['cpu.stat'])], parse_cpu, compute_cpu)
+
+def parse_percpu(contents, prev):
+    value = {'usage': array.array('d', [float(used) for used in contents['cpuacct.usage_percpu'].split()]), 'time': monotonic()}
+    if prev is not None and len(prev['usage']) == len(value['usage']):
+        value['diff'] = array.array('d', map(operator.sub, value['usage'], prev['usage']))
+        value['elapsed'] = value['time'] - prev['time']
+    return value
+
+def compute_percpu(line, value, system):
+    # Per CPU usage, in CPUs busy. Imbalance is 0 when all CPUs are equally
+    # busy, close to 1 when a single one does all the work.
+    line['cpu_imbalance'] = 0.0
+    if 'diff' in (value or {}):
+        scale = 1e9 * value['elapsed']
+        line['cpu_percpu'] = array.array('d', [used / scale for used in value['diff']])
+        busiest = max(line['cpu_percpu'])
+        if busiest > 0:
+            line['cpu_imbalance'] = 1 - sum(line['cpu_percpu']) / len(value['diff']) / busiest
+
+register('cpu.percpu', [('cpuacct', ['cpuacct.usage_percpu'])], parse_percpu, compute_percpu, details=True)
+
+def blkio_plugin(kind, name, offset):
+    '''
+    BlockIO bytes (offset 0) or operations (offset 2), read and write per
+    device. The v2 'io.stat' file holds both, it is read once for the two.
+    '''
+    def parse(contents, prev):
+        if 'io.stat' in contents:
+            devices = dict((device, values[offset:offset+2]) for device, values in parse_io_stat(contents['io.stat']).items())
+            total = sum(values[0] + values[1] for values in devices.values())
+        else:
+            devices, total = parse_blkio(contents[name])
+
+        value = {'devices': devices, 'total': total, 'time': monotonic()}
+        if prev is not None:
+            value['diff'] = dict(
+                (device, [used - prev_used for used, prev_used in zip(values, prev['devices'][device])])
+                for device, values in devices.items() if device in prev['devices']
+            )
+            value['total_diff'] = total - prev['total']
+            value['elapsed'] = value['time'] - prev['time']
+        return value
+
+    def compute(line, value, system):
+        # Per device rates: [read B/s, write B/s, read IOPS, write IOPS]
+        devices = line.setdefault('blkio_devices', {})
+        if 'diff' in (value or {}):
+            for device, values in value['diff'].items():
+                devices.setdefault(block_device_name(device), [0.0] * 4)[offset:offset+2] = [used / value['elapsed'] for used in values]
+        line['blkio_read_' + kind] = sum(values[offset] for values in devices.values())
+        line['blkio_write_' + kind] = sum(values[offset+1] for values in devices.values())
+        if offset == 0:
+            line['blkio_bw_bytes'] = value['total_diff'] / value['elapsed'] if 'diff' in (value or {}) else 0.0
+
+    return 'blkio.' + kind, [('blkio', [name]), ('unified', ['io.stat'])], parse, compute
+
+register(*blkio_plugin('bytes', 'blkio.throttle.io_service_bytes', 0))
+register(*blkio_plugin('iops', 'blkio.throttle.io_serviced', 2))
+
+def parse_memory(contents, prev):
+    '''
+    Memory usage, page cache excluded, and limit
+    '''
+    memory_stat = dict(line.split() for line in contents['memory.stat'].strip().split('\n'))
+    return {'usage': int(contents['memory.usage_in_bytes']) - int(memory_stat['cache']), 'limit': int(contents['memory.limit_in_bytes'])}
+
+def compute_memory(line, value, system):
+    line['memory_cur_bytes'] = value['usage'] if value else 0
+    line['memory_limit_bytes'] = min(value['limit'], system['total_memory']) if value else system['total_memory']
+
+register('memory', [('memory', ['memory.usage_in_bytes', 'memory.stat', 'memory.limit_in_bytes'])], parse_memory, compute_memory)
+
+def parse_oom(contents, prev):
+    '''
+    OOM kills and memory limit hits, as counted by the kernel, and the limit
+    itself, None when there is none. The limit is also what memory events
+    notifications are registered on.
+    '''
+    if 'memory.events' in contents:
+        events = dict(line.split() for line in contents['memory.events'].strip().split('\n'))
+        limit = contents['memory.max'].strip()
+        return {'oom_kill': int(events.get('oom_kill', 0)), 'limit_hits': int(events['max']), 'limit': None if limit == 'max' else int(limit)}
+    oom_control = dict(line.split() for line in contents['memory.oom_control'].strip().split('\n'))
+    return {'oom_kill': int(oom_control.get('oom_kill', 0)), 'limit_hits': int(contents['memory.failcnt']), 'limit': int(contents['memory.limit_in_bytes'])}
+
+def compute_oom(line, value, system):
+    # The root cgroup has no limit to hit
+    if not value or line['cgroup'] == '/':
+        value = {}
+    line['oom_kills'] = value.get('oom_kill', 0)
+    line['limit_hits'] = value.get('limit_hits', 0)
+
+register('oom', [('memory', ['memory.oom_control', 'memory.failcnt', 'memory.limit_in_bytes']), ('unified', ['memory.events', 'memory.max'])], parse_oom, compute_oom)
+
+def parse_numa(contents, prev, cgroup):
+    '''
+    Memory per NUMA node, and the nodes of the CPUs the cgroup may run on.
+    The latter come from the closest cpuset, cached by cgroup discovery.
+    '''
+    cpu_nodes = get_cpu_nodes()
+    return {
+        'nodes': parse_numa_stat(contents['memory.numa_stat'], os.sysconf('SC_PAGE_SIZE')),
+        'local': CGROUP_DISCOVERY[cgroup.base_path].cpuset_nodes(cgroup, cpu_nodes) if cpu_nodes else None,
+    }
+
+def compute_numa(line, value, system):
+    # Memory on NUMA nodes the cgroup CPUs are not on
+    line['memory_remote'] = 0.0
+    if value is not None:
+        numa, local = value['nodes'], value['local']
+        line['memory_numa'] = [[node, size, local is None or node in local] for node, size in sorted(numa.items())]
+        if local is not None and sum(numa.values()):
+            line['memory_remote'] = sum(size for node, size in numa.items() if node not in local) / float(sum(numa.values()))
+
+register('memory.numa', [('memory', ['memory.numa_stat']), ('unified', ['memory.numa_stat'])], parse_numa, compute_numa, details=True, with_cgroup=True)
+
+def parse_pids_max(contents, prev):
+    value = contents['pids.max'].strip()
+    return int(value) if value.isdigit() else value
+
+def compute_pids_max(line, value, system):
+    line['max_tasks'] = value if value is not None else 'max'
+
+register('pids.max', [('pids', ['pids.max']), ('unified', ['pids.max'])], parse_pids_max, compute_pids_max)
+
+def pressure_plugin(resource):
+    '''
+    Pressure stall information of ``resource``, from the unified hierarchy
+    '''
+    name = resource + '.pressure'
+
+    def parse(contents, prev):
+        return parse_pressure(contents[name])
+
+    def compute(line, value, system):
+        line[resource + '_pressure'] = (value or {}).get('some', {}).get('avg10', 0.0)
+
+    return name, [('unified', [name])], parse, compute
+
+register(*pressure_plugin('cpu'), columns={
+    'cpu-pressure':    ("PSI-CPU", 7, '^', '{0: >%s.1f}', 'cpu_pressure',    'cpu_pressure',    ('cpu.pressure',)),
+})
+register(*pressure_plugin('memory'), columns={
+    'memory-pressure': ("PSI-MEM", 7, '^', '{0: >%s.1f}', 'memory_pressure', 'memory_pressure', ('memory.pressure',)),
+})
+register(*pressure_plugin('io'), columns={
+    'io-pressure':     ("PSI-IO",  7, '^', '{0: >%s.1f}', 'io_pressure',     'io_pressure',     ('io.pressure',)),
+})
+
+def parse_cfs(contents, prev):
+    '''
+    CFS bandwidth control: periods, throttled periods and throttled
+    nanoseconds counters, and the quota in CPUs
+    '''
+    cpu_stat = dict((key, int(value)) for key, value in (line.split() for line in contents['cpu.stat'].strip().split('\n')))
+    if 'cpu.max' in contents:
+        throttling = [cpu_stat.get('nr_periods', 0), cpu_stat.get('nr_throttled', 0), cpu_stat.get('throttled_usec', 0) * 1000]
+        quota, period = contents['cpu.max'].split()
+        quota = None if quota == 'max' else int(quota)
+    else:
+        throttling = [cpu_stat['nr_periods'], cpu_stat['nr_throttled'], cpu_stat['throttled_time']]
+        quota, period = int(contents['cpu.cfs_quota_us']), int(contents['cpu.cfs_period_us'])
+        quota = None if quota < 0 else quota
+
+    value = {
+        'throttling': throttling,
+        'quota': quota / float(period) if quota is not None else None,
+        'time': monotonic(),
+    }
+    if prev is not None:
+        value['diff'] = [cur - old for cur, old in zip(throttling, prev['throttling'])]
+        value['elapsed'] = value['time'] - prev['time']
+    return value
+
+def compute_cfs(line, value, system):
+    periods, throttled, throttled_time = (value or {}).get('diff', (0, 0, 0))
+    line['cpu_throttled'] = throttled / float(periods) if periods else 0.0
+    line['cpu_throttled_time'] = throttled_time / 1e9 / value['elapsed'] if 'diff' in (value or {}) else 0.0
+    line['cpu_quota'] = value['quota'] if value else None
+
+    # Share of the quota used, in CPUs
+    line['cpu_quota_used'] = 0.0
+    if line['cpu_quota']:
+        line['cpu_quota_used'] = (line['cpu_syst'] + line['cpu_user']) * system['total_cpu'] / line['cpu_quota']
+    line['cpu_quota_str'] = '{0:.1%}'.format(line['cpu_quota_used']) if line['cpu_quota'] else '-'
+
+register('cfs', [('cpu', ['cpu.stat', 'cpu.cfs_quota_us', 'cpu.cfs_period_us']), ('unified', ['cpu.stat', 'cpu.max'])], parse_cfs, compute_cfs, columns={
+    'cpu-throttle': ("THROTL", 6, '^', '{0: >%s.1%%}', 'cpu_throttled', 'cpu_throttled',  ('cpu.stat',)),
+    'cpu-quota':    ("QUOTA",  6, '^', '{0: >%ss}',    'cpu_quota_str', 'cpu_quota_used', ('cpu.stat', 'cpuacct.usage_user', 'cpuacct.usage_sys')),
+})
+
 ## Grab cgroup data
 
-def init():
+def init(mounts_file="/proc/mounts"):
     # Get all cgroup subsystems avalaible on this system
     with open("/proc/cgroups") as f:
         cgroups = f.read().strip()
@@ -357,12 +1299,18 @@ def init():
         subsystems.append(cgroup.split()[0])
 
     # Match cgroup mountpoints to susbsytems. Always take the first matching
-    with open("/proc/mounts") as f:
+    with open(mounts_file) as f:
         mounts = f.read().strip()
 
     for mount in mounts.split('\n'):
         mount = mount.split(' ')
 
+        # Unified hierarchy (cgroup v2). Only used for v2 specific metrics.
+        if mount[2] == "cgroup2":
+            if 'unified' not in CGROUP_MOUNTPOINTS:
+                CGROUP_MOUNTPOINTS['unified'] = mount[1]
+            continue
+
         if mount[2] != "cgroup":
             continue
 
@@ -370,16 +1318,70 @@ def init():
             if arg in subsystems and arg not in CGROUP_MOUNTPOINTS:
                 CGROUP_MOUNTPOINTS[arg] = mount[1]
 
+def pids_current(path):
+    '''
+    Threads in the sub-tree of pids cgroup ``path``, read once per refresh.
+    None when not tracked: root cgroup, controller not enabled or cgroup
+    removed.
+    '''
+    if PIDS_CURRENT['tick'] != TICK['count']:
+        PIDS_CURRENT['tick'] = TICK['count']
+        PIDS_CURRENT['values'] = {}
+
+    values = PIDS_CURRENT['values']
+    if path not in values:
+        try:
+            with open(os.path.join(path, 'pids.current')) as f:
+                values[path] = int(f.read())
+        except (IOError, OSError) as e:
+            if e.errno not in VANISHED:
+                raise
+            values[path] = None
+    return values[path]
+
+def count_threads(cgroup):
+    '''
+    Return (own threads count, sub-tree threads count or None). Read the kernel
+    'pids.current' counter when the pids controller tracks ``cgroup``, like
+    'pids.max' it covers the whole sub-tree. Own threads are that minus the
+    counters of all its discovered children, whether listed or not. Otherwise
+    count the lines of the tasks file, without parsing thread IDs.
+    '''
+    if cgroup.base_path == CGROUP_MOUNTPOINTS.get('unified'):
+        base_path = cgroup.base_path
+    else:
+        base_path = CGROUP_MOUNTPOINTS.get('pids')
+
+    discovery = CGROUP_DISCOVERY.get(base_path)
+    path = os.path.normpath(os.path.join(base_path, cgroup.short_path.lstrip('/'))) if base_path else None
+    if discovery is not None and path in discovery.paths:
+        tree = pids_current(path)
+        if tree is not None:
+            own = tree
+            for child in discovery.children.get(path, ()):
+                # Leaves last found without tasks are not read again
+                if child in discovery.empty and not discovery.children.get(child):
+                    continue
+                own -= pids_current(child) or 0
+            # Threads may fork or move between two reads
+            return max(0, own), tree
+
+    return cgroup.read(cgroup.tasks_file).count('\n'), None
+
 def collect_ensure_common(data, cgroup):
     '''
     Some cgroup exists in only one controller. Attempt to collect common metrics
     (tasks clount, owner, ...) from the first controller we find the task in.
     '''
-    if 'tasks' in data:
+    if 'type' in data:
         return
 
-    # Collect
-    data['tasks'] = cgroup['tasks']
+    # Collect. Set 'type' last, it flags the common metrics as collected.
+    data['path'] = cgroup.short_path
+    data['time'] = monotonic()
+    if 'tasks' in READ_PLAN:
+        data['procs'] = cgroup.read('cgroup.procs').count('\n')
+        data['threads'], data['tree_threads'] = count_threads(cgroup)
     data['owner'] = cgroup.owner
     data['type'] = cgroup.type
 
@@ -396,68 +1398,145 @@ def get_user_beacounts():
     return output
 
 
-def collect(measures):
-    cur = defaultdict(dict)
-    prev = measures['data']
-
+def cpu_heat(data):
+    '''
+    Last known CPU usage rate of cgroup ``data``
+    '''
+    cpu = data.get('cpu') or {}
+    if 'diff' not in cpu:
+        return 0
+    return (cpu['diff']['user'] + cpu['diff']['system']) / cpu['elapsed']
 
-    # Collect CPU statistics
-    if 'cpuacct' in CGROUP_MOUNTPOINTS:
-        # list all "folders" under mountpoint
-        for cgroup in cgroups(CGROUP_MOUNTPOINTS['cpuacct']):
-            collect_ensure_common(cur[cgroup.name], cgroup)
+def plan_budget(prev):
+    '''
+    Pick the cgroups not to read on this refresh, to keep collection within
+    ``--cpu-budget``. The hottest cgroups are read on each refresh, the others
+    in turn, least recently read first. New cgroups are always read. Listing
+    cgroups costs the same whatever is read, it comes off the budget first.
+    '''
+    BUDGET['skip'] = set()
+    BUDGET['skipped'] = set()
+    BUDGET['listing'] = 0.0
+    if CONFIGURATION['cpu_budget'] is None or not BUDGET['cost']:
+        return
 
-            # Collect CPU stats
-            cur[cgroup.name]['cpuacct.stat'] = cgroup['cpuacct.stat']
-            cur[cgroup.name]['cpuacct.stat.diff'] = {'user':0, 'system':0}
+    budget = BUDGET_PLANNED_SHARE * CONFIGURATION['cpu_budget'] / 100.0 * CONFIGURATION['refresh_interval'] - BUDGET['fixed']
+    capacity = max(1, int(budget / BUDGET['cost']))
+    if capacity >= len(prev):
+        return
 
-            # Collect CPU increase on run > 1
-            if cgroup.name in prev:
-                for key, value in cur[cgroup.name]['cpuacct.stat'].items():
-                    cur[cgroup.name]['cpuacct.stat.diff'][key] = value - prev[cgroup.name]['cpuacct.stat'][key]
+    known = sorted(prev.values(), key=cpu_heat, reverse=True)
+    hot = int(capacity * BUDGET_HOT_SHARE)
+    others = sorted(known[hot:], key=lambda data: data['time'])
+    BUDGET['skip'] = set(data['path'] for data in others[capacity-hot:])
 
-    # Collect BlockIO statistics
-    if 'blkio' in CGROUP_MOUNTPOINTS:
-        # list all "folders" under mountpoint
-        for cgroup in cgroups(CGROUP_MOUNTPOINTS['blkio']):
-            collect_ensure_common(cur[cgroup.name], cgroup)
+def collect(measures):
+    cur = defaultdict(dict)
+    prev = measures['data']
 
-            # Collect BlockIO stats
+    TICK['count'] += 1
+    plan_budget(prev)
+    plugins_plan = plan_plugins()
+    measures['global']['collected'] = monotonic()
+    cpu_start = process_time()
+
+    # Collect metrics, one pass per hierarchy for all the plugins reading it
+    for mountpoint, plugins in plugins_plan.items():
+        # Only the cgroup of the drill-down pane, when no column needs them
+        only = set(name for _, _, name in plugins)
+        for cgroup in cgroups(mountpoint):
+            if None not in only and cgroup.name not in only:
+                continue
             try:
-                cur[cgroup.name]['blkio.throttle.io_service_bytes'] = cgroup['blkio.throttle.io_service_bytes']
-                cur[cgroup.name]['blkio.throttle.io_service_bytes.diff'] = {'total':0}
-            except IOError as e:
-                # Workaround broken systems (see #15)
-                if e.errno == errno.ENOENT:
+                collect_ensure_common(cur[cgroup.name], cgroup)
+            except (IOError, OSError) as e:
+                if e.errno in VANISHED:
                     continue
                 raise
+            collect_plugins(plugins, cur[cgroup.name], prev.get(cgroup.name, {}), cgroup)
+
+    # Kernel notifications registered on this refresh, by kind
+    watched = defaultdict(set)
+
+    # Register memory events notifications, for cgroups below a limit.
+    # Figures and limits are collected by the 'oom' plugin. Polled counters
+    # stand in for notifications that could not be registered, past the file
+    # descriptors cap for instance.
+    if CONFIGURATION['notify'] and ('memory' in CGROUP_MOUNTPOINTS or 'unified' in CGROUP_MOUNTPOINTS):
+        memory_v2 = 'memory' not in CGROUP_MOUNTPOINTS
+        for cgroup in cgroups(CGROUP_MOUNTPOINTS['unified' if memory_v2 else 'memory']):
+            events = cur.get(cgroup.name, {}).get('oom')
+            if cgroup.name == "/" or events is None:
+                continue
+
+            # Out of memory kills only happen below a limit, or host wide
+            limit = events['limit']
+            if limit is None or limit >= measures['global']['total_memory']:
+                continue
 
-            # Collect BlockIO increase on run > 1
-            if cgroup.name in prev:
-                cur_val = cur[cgroup.name]['blkio.throttle.io_service_bytes']['Total']
-                prev_val = prev[cgroup.name]['blkio.throttle.io_service_bytes']['Total']
-                cur[cgroup.name]['blkio.throttle.io_service_bytes.diff']['total'] = cur_val - prev_val
-
-    # Collect memory statistics
-    if 'memory' in CGROUP_MOUNTPOINTS:
-        # list all "folders" under mountpoint
-        for cgroup in cgroups(CGROUP_MOUNTPOINTS['memory']):
-            collect_ensure_common(cur[cgroup.name], cgroup)
-            cache = cgroup['memory.stat']['cache']
-            cur[cgroup.name]['memory.usage_in_bytes'] = cgroup['memory.usage_in_bytes'] - cache
-            cur[cgroup.name]['memory.limit_in_bytes'] = min(int(cgroup['memory.limit_in_bytes']), measures['global']['total_memory'])
-
-    # Collect PIDs constraints. Root cgroup does *not* have the controller files
-    if 'pids' in CGROUP_MOUNTPOINTS:
-        # list all "folders" under mountpoint
-        for cgroup in cgroups(CGROUP_MOUNTPOINTS['pids']):
-            if cgroup.name == "/":
+            if memory_v2:
+                path = os.path.join(cgroup.path, 'memory.events')
+                notified = watch_memory_events(path, cgroup.name)
+                watched['memory.events'].add(path)
+            else:
+                path = os.path.join(cgroup.path, 'memory.oom_control')
+                notified = watch_memory_event(path, cgroup.name, 'oom')
+                watched['oom'].add(path)
+
+                # Move the usage threshold with the limit
+                path = os.path.join(cgroup.path, 'memory.usage_in_bytes')
+                threshold = int(limit * MEMORY_THRESHOLD)
+                if prev.get(cgroup.name, {}).get('memory.threshold', threshold) != threshold and path in EVENTS['paths']:
+                    unwatch(path)
+                notified = watch_memory_event(path, cgroup.name, 'threshold', threshold) and notified
+                watched['threshold'].add(path)
+                cur[cgroup.name]['memory.threshold'] = threshold
+
+            last = prev.get(cgroup.name, {}).get('oom') or events
+            if not notified and (events['oom_kill'] > last['oom_kill'] or events['limit_hits'] > last['limit_hits']):
+                CONFIGURATION['alerts'][cgroup.name] = time.time()
+
+    # Register pressure stall triggers. Only exposed by the unified hierarchy,
+    # figures are collected by the 'pressure' plugins. Polled figures stand
+    # in for triggers that could not be registered.
+    if 'unified' in CGROUP_MOUNTPOINTS and CONFIGURATION['psi_alert']:
+        for cgroup in cgroups(CGROUP_MOUNTPOINTS['unified']):
+            for resource in PRESSURE_RESOURCES:
+                name = resource + '.pressure'
+                path = os.path.join(cgroup.path, name)
+                watched['pressure'].add(path)
+                if not watch_pressure(path, cgroup.name) and pressure_stalled(cur.get(cgroup.name, {}), prev.get(cgroup.name, {}), name):
+                    CONFIGURATION['alerts'][cgroup.name] = time.time()
+
+    # Keep the last figures of cgroups left out of this refresh by the CPU
+    # budget. Their rates are computed over the whole period on next read.
+    read = len(cur)
+    carried = set()
+    for name, data in prev.items():
+        if name not in cur and data.get('path') in BUDGET['skipped']:
+            cur[name] = data
+            carried.add(name)
+
+    # Drop notifications of removed cgroups, or of disabled features
+    for kind in ['pressure'] + MEMORY_EVENT_KINDS:
+        unwatch_stale(kind, watched[kind], carried)
+
+    # Nothing to read from controllers, still list cgroups
+    if not cur:
+        for controller in ['cpuacct', 'memory', 'blkio', 'pids', 'unified']:
+            if controller not in CGROUP_MOUNTPOINTS:
                 continue
-            collect_ensure_common(cur[cgroup.name], cgroup)
-            cur[cgroup.name]['pids.max'] = cgroup['pids.max']
+            for cgroup in cgroups(CGROUP_MOUNTPOINTS[controller]):
+                try:
+                    collect_ensure_common(cur[cgroup.name], cgroup)
+                except (IOError, OSError) as e:
+                    if e.errno in VANISHED:
+                        continue
+                    raise
+            break
 
     #Collect memory statistics for openvz
-    if HAS_OPENVZ:
+    if HAS_OPENVZ and 'memory.usage_in_bytes' in READ_PLAN:
         user_beancounters = get_user_beacounts()
         # We have lines like -
         #      1202     202419    2457600
@@ -474,57 +1553,128 @@ def collect(measures):
                 continue
             ctid, privvmpages, limit = splited_line
             ctid = '/' + ctid
-            if 'tasks' not in cur[ctid]:
+            if 'type' not in cur[ctid]:
                 continue
             privvmpages = int(privvmpages)
             privvmpages = privvmpages * 4096
             limit = int(limit)
             limit = limit * 4096
-            cur[ctid]['memory.usage_in_bytes'] = privvmpages
-            cur[ctid]['memory.limit_in_bytes'] = min(limit, measures['global']['total_memory'])
+            cur[ctid]['memory'] = {'usage': privvmpages, 'limit': limit}
+
+    # Drop cgroups removed before we could collect common metrics
+    for name in [name for name, data in cur.items() if 'type' not in data]:
+        del cur[name]
 
     # Sanity check: any data at all ?
     if not len(cur):
         raise KeyboardInterrupt()
 
+    if CONFIGURATION['export_folded']:
+        accumulate_folded(cur, measures['global']['collected'])
+
+    # Collection cost per cgroup, listing excluded, for the CPU budget
+    if read:
+        cost = (process_time() - cpu_start - BUDGET['listing']) / read
+        BUDGET['cost'] = cost if BUDGET['cost'] is None else (BUDGET['cost'] + cost) / 2
+        BUDGET['fixed'] = (BUDGET['fixed'] + BUDGET['listing']) / 2
+
     # Apply
     measures['data'] = cur
 
-def built_statistics(measures, conf):
-    # Time
-    prev_time = measures['global'].get('time', -1)
-    cur_time = time.time()
-    time_delta = cur_time - prev_time
-    measures['global']['time'] = cur_time
-    cpu_to_percent = measures['global']['scheduler_frequency'] * measures['global']['total_cpu'] * time_delta
-
-    # Build data lines
+def accumulate_folded(data, collected):
+    '''
+    Add the CPU time each cgroup used since its last read, children excluded,
+    to the folded stacks. Cgroups not read since ``collected`` are skipped.
+    '''
+    usage = {}
+    for values in data.values():
+        cpu = values.get('cpu') or {}
+        if 'diff' in cpu and cpu['time'] >= collected:
+            usage[values['path']] = cpu['diff']['user'] + cpu['diff']['system']
+
+    # cpuacct counters include children, subtract them from the closest
+    # collected ancestor
+    own = dict(usage)
+    for path, used in usage.items():
+        parent = path
+        while parent != '/':
+            parent = os.path.dirname(parent)
+            if parent in own:
+                own[parent] -= used
+                break
+
+    stacks = FOLDED['stacks']
+    for path, used in own.items():
+        if used > 0:
+            stacks[path] += used
+
+    # Bound memory on hosts with many short lived cgroups
+    if len(stacks) > FOLDED_MAX_STACKS:
+        for path in sorted(stacks, key=stacks.get)[:len(stacks) - FOLDED_MAX_STACKS * 3 // 4]:
+            if path != '/':
+                stacks[os.path.dirname(path)] += stacks.pop(path)
+
+    if time.time() - FOLDED['written'] >= FOLDED_WRITE_INTERVAL:
+        write_folded(CONFIGURATION['export_folded'])
+
+def write_folded(path):
+    '''
+    Write the folded stacks to ``path``, one 'parent;child <microseconds>'
+    line per cgroup, the root cgroup being '[root]'. Replaced atomically, so
+    that it can be read during capture.
+    '''
+    FOLDED['written'] = time.time()
+    with open(path + '.tmp', 'w') as f:
+        for cgroup, used in sorted(FOLDED['stacks'].items()):
+            if used >= 1000:
+                f.write('%s %d\n' % (';'.join(cgroup.strip('/').split('/')) or '[root]', used // 1000))
+    os.rename(path + '.tmp', path)
+
+def built_samples(measures):
+    '''
+    Build one line of raw figures per cgroup. Human readable fields are added
+    by ``decorate_line``.
+    '''
+    cur_time = monotonic()
+
+    # Build data lines, figures are added by plugins
     results = []
     for cgroup, data in measures['data'].items():
-        cpu_usage = data.get('cpuacct.stat.diff', {})
         line = {
             'owner': str(data.get('owner', 'nobody')),
             'type': str(data.get('type', 'cgroup')),
-            'cur_tasks': len(data['tasks']),
-            'max_tasks': data.get('pids.max', 'max'),
-            'memory_cur_bytes': data.get('memory.usage_in_bytes', 0),
-            'memory_limit_bytes': data.get('memory.limit_in_bytes', measures['global']['total_memory']),
-            'cpu_total_seconds': data.get('cpuacct.stat', {}).get('system', 0) + data.get('cpuacct.stat', {}).get('user', 0),
-            'cpu_syst': cpu_usage.get('system', 0) / cpu_to_percent,
-            'cpu_user': cpu_usage.get('user', 0) / cpu_to_percent,
-            'blkio_bw_bytes': data.get('blkio.throttle.io_service_bytes.diff', {}).get('total', 0),
+            'cur_procs': data.get('procs', 0),
+            'cur_tasks': data.get('threads', 0),
+            'tree_tasks': data.get('tree_threads'),
+            'age': max(0.0, measures['global']['collected'] - data.get('time', cur_time)),
             'cgroup': cgroup,
         }
-        line['cpu_total'] = line['cpu_syst'] + line['cpu_user'],
-        line['cpu_total_str'] = to_human_time(line['cpu_total_seconds'])
-        line['memory_cur_percent'] = line['memory_cur_bytes'] / line['memory_limit_bytes']
-        line['memory_cur_str'] = "{0: >7}/{1: <7}".format(to_human(line['memory_cur_bytes']), to_human(line['memory_limit_bytes']))
-        line['tasks'] = "{0: >5}/{1: <5}".format(line['cur_tasks'], line['max_tasks'])
-        line['blkio_bw'] = to_human(line['blkio_bw_bytes'], 'B/s')
+
+        for plugin in PLUGINS:
+            plugin.compute(line, data.get(plugin.name), measures['global'])
+
         results.append(line)
 
     return results
 
+def decorate_line(line):
+    '''
+    Add computed and human readable fields to a raw sample line
+    '''
+    line['cpu_total'] = line['cpu_syst'] + line['cpu_user']
+    line['cpu_total_str'] = to_human_time(line['cpu_total_seconds'])
+    line['memory_cur_percent'] = line['memory_cur_bytes'] / line['memory_limit_bytes']
+    line['memory_cur_str'] = "{0: >7}/{1: <7}".format(to_human(line['memory_cur_bytes']), to_human(line['memory_limit_bytes']))
+    line['tasks'] = "{0: >5}/{1: >5}/{2: <5}".format(line['cur_procs'], line['cur_tasks'], line['max_tasks'])
+    line['memory_events'] = "{0}/{1}".format(line['oom_kills'], line['limit_hits'])
+    line['blkio_bw'] = to_human(line['blkio_bw_bytes'], 'B/s')
+    line['blkio_read_bw'] = to_human(line['blkio_read_bytes'], 'B/s')
+    line['blkio_write_bw'] = to_human(line['blkio_write_bytes'], 'B/s')
+    return line
+
+def built_statistics(measures, conf):
+    return [decorate_line(line) for line in built_samples(measures)]
+
 def render_tree(results, tree, level=0, prefix=[], node='/'):
     # Exit condition
     if node not in tree:
@@ -586,16 +1736,18 @@ def prepare_tree(results):
 
     ## Tree view
     tree = {}
+    roots = []
     rendered = []
+    cgroups = set(line['cgroup'] for line in results)
 
     # Build tree
     for line in results:
         cgroup = line['cgroup']
         parent = os.path.dirname(cgroup)
 
-        # Root cgroup ?
-        if parent == cgroup:
-            rendered.append(line)
+        # Root cgroup ? Or top of a --root / remote host sub-tree ?
+        if parent == cgroup or parent not in cgroups:
+            roots.append(line)
             continue
 
         # Insert in hierarchie as needed
@@ -603,21 +1755,72 @@ def prepare_tree(results):
             tree[parent] = []
         tree[parent].append(line)
 
-    # If there are filters, filter
-    if CONFIGURATION['type']:
-         filter_tree(tree, CONFIGURATION['type'])
-
-    # Render tree, starting from root
-    render_tree(rendered, tree)
+    # Render tree, starting from roots. If there are filters, filter
+    for line in roots:
+        if CONFIGURATION['type']:
+            filter_tree(tree, CONFIGURATION['type'], line['cgroup'])
+        rendered.append(line)
+        render_tree(rendered, tree, node=line['cgroup'])
     return rendered
 
+def rollup(results):
+    '''
+    Attach sub-tree totals to each line as '_rollup'. Computed in a single
+    post-order pass, deepest cgroups first, and reused across redraws until
+    new data arrives.
+    '''
+    if ROLLUP['results'] is results:
+        return
+    ROLLUP['results'] = results
+
+    fields = ROLLUP_FIELDS
+    if 'blkio' in CGROUP_MOUNTPOINTS or CONFIGURATION['remotes']:
+        fields = fields + ROLLUP_FIELDS_BLKIO
+
+    # Hierarchy index
+    lines = {}
+    depths = defaultdict(list)
+    for line in results:
+        cgroup = line['cgroup']
+        lines[cgroup] = line
+        depths[cgroup.count('/') if cgroup != '/' else 0].append(line)
+        line['_rollup'] = dict(line)
+
+    # Children first
+    for depth in sorted(depths, reverse=True):
+        for line in depths[depth]:
+            parent = lines.get(os.path.dirname(line['cgroup']))
+            if parent is None or parent is line:
+                continue
+            for field in fields:
+                parent['_rollup'][field] += line['_rollup'][field]
+
+    for line in results:
+        decorate_line(line['_rollup'])
+
 def display(scr, results, conf):
+    # Sub-tree totals, for folded lines and aggregate view
+    rollup(results)
+    if conf['aggregate']:
+        sort_key = lambda line: line['_rollup'].get(conf['sort_by'], 0)
+    else:
+        sort_key = lambda line: line.get(conf['sort_by'], 0)
+
     # Sort and render
-    results = sorted(results, key=lambda line: line.get(conf['sort_by'], 0), reverse=not conf['sort_asc'])
+    results = sorted(results, key=sort_key, reverse=not conf['sort_asc'])
+    if conf['remotes']:
+        # Group by host, keeping the sort order within each host
+        results = sorted(results, key=lambda line: line['host'])
     results = prepare_tree(results)
 
     CONFIGURATION['cgroups'] = [cgroup['cgroup'] for cgroup in results]
 
+    # Expire alerts
+    now = time.time()
+    for cgroup, since in list(CONFIGURATION['alerts'].items()):
+        if now - since > ALERT_TIMEOUT:
+            del CONFIGURATION['alerts'][cgroup]
+
     # Ensure selected line name synced with num
     if results:
         if CONFIGURATION['follow']:
@@ -627,7 +1830,11 @@ def display(scr, results, conf):
                     CONFIGURATION['selected_line_num'] = i
                     break
                 except:
-                    CONFIGURATION['selected_line_name'] = os.path.dirname(CONFIGURATION['selected_line_name'])
+                    parent = os.path.dirname(CONFIGURATION['selected_line_name'])
+                    # No displayed parent, when scoped with --root or search
+                    if parent == CONFIGURATION['selected_line_name']:
+                        parent = CONFIGURATION['cgroups'][0]
+                    CONFIGURATION['selected_line_name'] = parent
         else:
             CONFIGURATION['selected_line_num'] = min(len(results)-1, CONFIGURATION['selected_line_num'])
             CONFIGURATION['selected_line_name'] = CONFIGURATION['cgroups'][CONFIGURATION['selected_line_num']]
@@ -640,6 +1847,8 @@ def display(scr, results, conf):
     # Get display informations
     height, width = scr.getmaxyx()
     list_height = height - 2 # title + status lines
+    if CONFIGURATION['details']:
+        list_height -= DETAILS_HEIGHT
 
     # Update offset
     max_offset = max(0, len(results) - list_height)
@@ -679,9 +1888,14 @@ def display(scr, results, conf):
     # Content
     lineno = 1
     for line in results[CONFIGURATION['offset']:]:
+        if lineno > list_height:
+            break
+
         y = 0
         if lineno-1 == CONFIGURATION['selected_line_num']-CONFIGURATION['offset']:
             col_reg, col_tree = curses.color_pair(2), curses.color_pair(2)
+        elif line['cgroup'] in CONFIGURATION['alerts']:
+            col_reg, col_tree = curses.color_pair(5), curses.color_pair(5)
         else:
             col_reg, col_tree = colors = curses.color_pair(0), curses.color_pair(4)
 
@@ -693,10 +1907,15 @@ def display(scr, results, conf):
             break
 
         # Draw line content
+        # Folded lines show their sub-tree totals
+        figures = line
+        if conf['aggregate'] or CONFIGURATION['tree'] and line['cgroup'] in CONFIGURATION['fold']:
+            figures = line['_rollup']
+
         try:
             for col in COLUMNS:
                 cell_tpl = col.col_fmt % (col.width if col.width else 1)
-                data_point = line.get(col.col_data, '')
+                data_point = figures.get(col.col_data, '')
 
                 if col.title == 'CGROUP' and CONFIGURATION['tree']:
                     data_point = os.path.basename(data_point) or '[root]'
@@ -705,6 +1924,9 @@ def display(scr, results, conf):
                         scr.addch(c, col_tree)
                         y+=1
 
+                if col.title == 'CGROUP' and line['cgroup'] in CONFIGURATION['self']:
+                    data_point += ' [ctop]'
+
                 scr.addstr(lineno, y, cell_tpl.format(data_point)+' ', col_reg)
                 if col.width:
                     y += col.width + 1
@@ -717,6 +1939,14 @@ def display(scr, results, conf):
         try: scr.addstr(lineno, 0, ' '*width)
         except _curses.error: pass
 
+    # Drill-down pane
+    if CONFIGURATION['details']:
+        try:
+            display_details(scr, CONFIGURATION['selected_line'] or {}, height - 1 - DETAILS_HEIGHT, width)
+        except _curses.error:
+            # Handle small screens
+            pass
+
     # status line
     try:
         color = curses.color_pair(2)
@@ -736,14 +1966,23 @@ def display(scr, results, conf):
         scr.addch(curses.ACS_VLINE, color)
         scr.addstr(" [F5] Toggle %s view "%('list' if CONFIGURATION['tree'] else 'tree'), color)
         scr.addch(curses.ACS_VLINE, color)
+        scr.addstr(" [D]etails: "+('On ' if CONFIGURATION['details'] else 'Off '), color)
+        scr.addch(curses.ACS_VLINE, color)
+        scr.addstr(" [T]otals: "+('On ' if CONFIGURATION['aggregate'] else 'Off '), color)
+        scr.addch(curses.ACS_VLINE, color)
+        if CONFIGURATION['searching'] or CONFIGURATION['search']:
+            scr.addstr(" /"+CONFIGURATION['search']+('_ ' if CONFIGURATION['searching'] else ' '), color)
+        else:
+            scr.addstr(" [/] Search ", color)
+        scr.addch(curses.ACS_VLINE, color)
 
         # Fold control
         if CONFIGURATION['tree']:
             scr.addstr(" [+/-] %s "%('unfold' if selected.get('cgroup', '') in CONFIGURATION['fold'] else 'fold'), color)
             scr.addch(curses.ACS_VLINE, color)
 
-        # Do we have any actions available for *selected* line ?
-        selected_type = selected.get('type', '')
+        # Do we have any actions available for *selected* line ? Not on remote hosts.
+        selected_type = selected.get('type', '') if 'host' not in selected else ''
         if selected_type == 'docker' and HAS_DOCKER or \
            selected_type in ['lxc', 'lxc-user'] and HAS_LXC or \
            selected_type == 'qemu-kvm' and HAS_LIBVIRT or \
@@ -763,15 +2002,89 @@ def display(scr, results, conf):
 
     scr.refresh()
 
+def display_details(scr, line, y, width):
+    '''
+    Drill-down pane for the selected cgroup ``line``, starting at screen line
+    ``y``: per device BlockIO bandwidth and operations. Per CPU usage heatmap
+    and per NUMA node memory when available and the screen is wide enough.
+    '''
+    scr.addstr(y, 0, ' '*width, curses.color_pair(1))
+    scr.addstr(y, 0, '{0:<16} {1:^10} {2:^10} {3:^7} {4:^7} '.format('DEVICE', 'READ', 'WRITE', 'R-IOPS', 'W-IOPS'), curses.color_pair(1))
+
+    devices = sorted(line.get('blkio_devices', {}).items(), key=lambda device: device[1][0] + device[1][1], reverse=True)
+    for i in range(1, DETAILS_HEIGHT):
+        scr.addstr(y+i, 0, ' '*width)
+        if i > len(devices):
+            continue
+        name, (read, write, read_iops, write_iops) = devices[i-1]
+        scr.addstr(y+i, 0, '{0:<16} {1: >10} {2: >10} {3: >7.0f} {4: >7.0f}'.format(name, to_human(read, 'B/s'), to_human(write, 'B/s'), read_iops, write_iops))
+
+    groups = min(8, (width - DETAILS_SIDE_X - 5) // 9)
+    if groups < 1:
+        return
+
+    # (text, is title) lines
+    side = []
+
+    # One cell per CPU, by groups of 8, each line starting with its first CPU
+    percpu = line.get('cpu_percpu')
+    if percpu is not None:
+        side.append(('CPU {0}, IMBALANCE {1:.0%}'.format(len(percpu), line['cpu_imbalance']), True))
+        per_row = 8 * groups
+        shades = len(HEATMAP_SHADES) - 1
+        for first in range(0, len(percpu), per_row):
+            cells = ''.join(HEATMAP_SHADES[min(shades, int(round(busy * shades)))] for busy in percpu[first:first+per_row])
+            cells = ' '.join(cells[i:i+8] for i in range(0, len(cells), 8))
+            side.append(('{0: >4} {1}'.format(first, cells), False))
+
+    numa = line.get('memory_numa')
+    if numa:
+        side.append(('NODE  MEMORY     REMOTE {0:.0%}'.format(line['memory_remote']), True))
+        for node, size, local in numa:
+            side.append(('{0: >4} {1: >7}    {2}'.format(node, to_human(size), 'local' if local else 'remote'), False))
+
+    for i, (text, title) in enumerate(side[:DETAILS_HEIGHT]):
+        if title:
+            scr.addstr(y+i, DETAILS_SIDE_X, text, curses.color_pair(1))
+        else:
+            scr.addstr(y+i, DETAILS_SIDE_X, text)
+
 def set_sort_col(sort_by):
     if CONFIGURATION['sort_by'] == sort_by:
         CONFIGURATION['sort_asc'] = not CONFIGURATION['sort_asc']
     else:
         CONFIGURATION['sort_by'] = sort_by
+        rebuild_read_plan()
+
+def set_search(pattern):
+    '''
+    Update the incremental search. Matching is case insensitive, on the full
+    cgroup path.
+    '''
+    CONFIGURATION['search'] = pattern
+    CONFIGURATION['search_regex'] = re.compile(re.escape(pattern), re.IGNORECASE) if pattern else None
+
+def on_search_keyboard(c):
+    '''Handle keyboard while typing a search'''
+    if c in (10, 13, curses.KEY_ENTER):
+        CONFIGURATION['searching'] = False
+        return 2
+    elif c == 27: # Escape
+        CONFIGURATION['searching'] = False
+        set_search('')
+    elif c in (8, 127, curses.KEY_BACKSPACE):
+        set_search(CONFIGURATION['search'][:-1])
+    elif 32 <= c < 127:
+        set_search(CONFIGURATION['search'] + chr(c))
+    else:
+        return 1
+    return 3
 
 def on_keyboard(c):
     '''Handle keyborad shortcuts'''
-    if c == ord('q'):
+    if CONFIGURATION['searching']:
+        return on_search_keyboard(c)
+    elif c == ord('q'):
         raise KeyboardInterrupt()
     elif c == ord('p'):
         CONFIGURATION['pause_refresh'] = not CONFIGURATION['pause_refresh']
@@ -781,6 +2094,17 @@ def on_keyboard(c):
     elif c == 269: # F5
         CONFIGURATION['tree'] = not CONFIGURATION['tree']
         return 2
+    elif c == ord('t'):
+        CONFIGURATION['aggregate'] = not CONFIGURATION['aggregate']
+        return 2
+    elif c == ord('/'):
+        CONFIGURATION['searching'] = True
+        set_search('')
+        return 3
+    elif c == ord('d'):
+        CONFIGURATION['details'] = not CONFIGURATION['details']
+        rebuild_read_plan()
+        return 2
     elif c == curses.KEY_DOWN:
         if CONFIGURATION['follow']:
             i = CONFIGURATION['cgroups'].index(CONFIGURATION['selected_line_name'])
@@ -809,6 +2133,9 @@ def on_keyboard(c):
         else:
             CONFIGURATION['fold'].append(cgroup)
         return 2
+    elif 'host' in CONFIGURATION['selected_line']:
+        # Actions are not available on remote hosts
+        return 1
     elif c == ord('a'):
         selected = CONFIGURATION['selected_line']
         selected_name = os.path.basename(selected['cgroup'])
@@ -920,6 +2247,7 @@ def event_listener(scr, timeout):
     return
      - 1 OK
      - 2 redraw
+     - 3 refresh now, collection scope changed
      - 0 error
     '''
     try:
@@ -936,16 +2264,278 @@ def event_listener(scr, timeout):
     except _curses.error:
         return 0
 
-def rebuild_columns():
-    del COLUMNS[:]
-    for col in CONFIGURATION['columns']+COLUMNS_MANDATORY:
-        COLUMNS.append(COLUMNS_AVAILABLE[col])
+## Kernel notifications
 
-def diagnose():
-    devnull = open(os.devnull, 'w')
-    if os.path.isfile('/.dockerenv'):
-        print("""
-Hint: It seems you are running inside a Docker container.
+def can_watch(path):
+    '''
+    Whether a watch may be registered on ``path``: not tried yet, and file
+    descriptors left for it under ``WATCH_FD_SHARE`` of RLIMIT_NOFILE.
+    '''
+    if EVENTS['capacity'] is None:
+        soft, _ = getrlimit(RLIMIT_NOFILE)
+        EVENTS['capacity'] = sys.maxsize if soft == RLIM_INFINITY else int(soft * WATCH_FD_SHARE)
+    return path not in EVENTS['paths'] and len(EVENTS['watches']) < EVENTS['capacity']
+
+def is_watched(path):
+    return EVENTS['paths'].get(path, (None, None))[1] is not None
+
+def watch_failed(path, kind, name, error):
+    '''
+    Record that ``path`` could not be watched, and return False. Out of file
+    descriptors, release half of the watches for cgroup files reads, they
+    fall back to polling. Otherwise the kernel or our privileges do not allow
+    it, do not retry.
+    '''
+    if error.errno in (errno.EMFILE, errno.ENFILE):
+        EVENTS['capacity'] = len(EVENTS['watches']) // 2
+        for fd in sorted(EVENTS['watches'])[EVENTS['capacity']:]:
+            unwatch(EVENTS['watches'][fd][2])
+    else:
+        EVENTS['paths'][path] = (kind, None, name)
+    return False
+
+def watch_fd(fd, kind, name, path, mask):
+    '''
+    Add ``fd`` to the set of file descriptors ``wait_events`` is waiting on.
+    ``name`` is the cgroup to flag when it fires. Return whether it is.
+    '''
+    try:
+        if EVENTS['poll'] is None:
+            EVENTS['poll'] = select.epoll()
+            EVENTS['poll'].register(sys.stdin.fileno(), select.EPOLLIN)
+        EVENTS['poll'].register(fd, mask)
+    except (IOError, OSError) as e:
+        os.close(fd)
+        return watch_failed(path, kind, name, e)
+
+    EVENTS['watches'][fd] = (kind, name, path)
+    EVENTS['paths'][path] = (kind, fd, name)
+    return True
+
+def unwatch(path):
+    kind, fd, name = EVENTS['paths'].pop(path)
+    if fd is None:
+        return
+
+    del EVENTS['watches'][fd]
+    EVENTS['poll'].unregister(fd)
+    os.close(fd)
+
+def unwatch_stale(kind, keep, names=()):
+    '''
+    Drop watches of type ``kind`` whose path is not in ``keep`` anymore,
+    unless they belong to one of the cgroups ``names``.
+    '''
+    for path, (watch_kind, fd, name) in list(EVENTS['paths'].items()):
+        if watch_kind == kind and path not in keep and name not in names:
+            unwatch(path)
+
+def watch_pressure(path, name):
+    '''
+    Register a PSI trigger on pressure file ``path``. From now on, the kernel
+    wakes ``wait_events`` with POLLPRI as soon as the cgroup stalls. Return
+    whether the trigger is registered.
+    '''
+    if not can_watch(path):
+        return is_watched(path)
+
+    # Unprivileged user, kernel without trigger support or out of file
+    # descriptors
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+    except OSError as e:
+        return watch_failed(path, 'pressure', name, e)
+
+    try:
+        os.write(fd, PSI_TRIGGER.encode('ascii') + b'\0')
+    except OSError as e:
+        os.close(fd)
+        return watch_failed(path, 'pressure', name, e)
+
+    return watch_fd(fd, 'pressure', name, path, select.EPOLLPRI)
+
+def pressure_stalled(data, prev, name):
+    '''
+    Polled stand-in for a PSI trigger: whether tasks of cgroup ``data`` stalled
+    on pressure file ``name`` for as long as ``PSI_TRIGGER`` asks, in share of
+    the time since ``prev`` was read.
+    '''
+    if data.get(name) is None or prev.get(name) is None:
+        return False
+
+    stall, window = [int(field) for field in PSI_TRIGGER.split()[1:]]
+    elapsed = data['time'] - prev['time']
+    stalled = data[name]['some']['total'] - prev[name]['some']['total']
+    return elapsed > 0 and stalled >= elapsed * 1e6 * stall / window
+
+def eventfd():
+    '''
+    Create a non-blocking eventfd
+    '''
+    if hasattr(os, 'eventfd'):
+        # Python >= 3.10
+        return os.eventfd(0, os.EFD_CLOEXEC | os.EFD_NONBLOCK)
+    if libc is None:
+        raise OSError(errno.ENOSYS, "eventfd is not available")
+    fd = libc.eventfd(0, EFD_CLOEXEC | EFD_NONBLOCK)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "eventfd failed")
+    return fd
+
+def watch_memory_event(path, name, kind, threshold=None):
+    '''
+    Register an eventfd for cgroup v1 memory control file ``path``, with an
+    optional usage ``threshold``. The kernel signals it on OOM or when usage
+    crosses the threshold, and on cgroup removal. Return whether it is
+    registered.
+    '''
+    if not can_watch(path):
+        return is_watched(path)
+
+    # Controller without notification support, or out of file descriptors
+    try:
+        efd = eventfd()
+    except OSError as e:
+        return watch_failed(path, kind, name, e)
+
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            with open(os.path.join(os.path.dirname(path), 'cgroup.event_control'), 'w') as f:
+                f.write('%d %d' % (efd, fd) + (' %d' % threshold if threshold is not None else ''))
+        finally:
+            os.close(fd)
+    except (IOError, OSError) as e:
+        os.close(efd)
+        return watch_failed(path, kind, name, e)
+
+    return watch_fd(efd, kind, name, path, select.EPOLLIN)
+
+def watch_memory_events(path, name):
+    '''
+    Poll cgroup v2 'memory.events' file ``path``. The kernel wakes pollers
+    with POLLPRI each time a counter changes. Return whether it is polled.
+    '''
+    if not can_watch(path):
+        return is_watched(path)
+
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError as e:
+        return watch_failed(path, 'memory.events', name, e)
+
+    # Notifications fire for changes after the last read
+    try:
+        os.read(fd, 4096)
+    except OSError as e:
+        os.close(fd)
+        return watch_failed(path, 'memory.events', name, e)
+
+    return watch_fd(fd, 'memory.events', name, path, select.EPOLLPRI)
+
+def acknowledge(fd, kind, path):
+    '''
+    Consume a memory notification from ``fd``, so that it does not fire
+    again. Return False if the cgroup was removed.
+    '''
+    try:
+        if kind == 'memory.events':
+            # Reading the file again re-arms the notification
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.read(fd, 4096)
+        else:
+            os.read(fd, 8)
+    except OSError as e:
+        if e.errno in VANISHED:
+            return False
+        if e.errno != errno.EAGAIN:
+            raise
+    return os.path.isdir(os.path.dirname(path))
+
+def wait_events(scr, timeout):
+    '''
+    Wait for curses events on screen ``scr`` or kernel notifications at most
+    ``timeout`` ms. Kernel notifications flag the matching cgroup in
+    ``CONFIGURATION['alerts']`` and trigger a redraw. Memory events trigger
+    a refresh, to show the new counters.
+
+    return: same as ``event_listener``
+    '''
+    if not EVENTS['watches']:
+        return event_listener(scr, timeout)
+
+    try:
+        ready = EVENTS['poll'].poll(timeout / 1000.0 if timeout >= 0 else -1)
+    except (IOError, OSError) as e:
+        if e.errno != errno.EINTR:
+            raise
+        ready = []
+
+    fired = False
+    memory_event = False
+    for fd, mask in ready:
+        if fd not in EVENTS['watches']:
+            # stdin, handled by curses below
+            continue
+
+        kind, name, path = EVENTS['watches'][fd]
+        if kind in MEMORY_EVENT_KINDS:
+            # Pollers of kernfs files get POLLERR on each change
+            if not acknowledge(fd, kind, path):
+                unwatch(path)
+                continue
+            memory_event = True
+        elif mask & select.EPOLLERR:
+            # The cgroup was removed
+            unwatch(path)
+            continue
+
+        CONFIGURATION['alerts'][name] = time.time()
+        fired = True
+
+    ret = event_listener(scr, 0)
+    if fired and ret == 1:
+        ret = 2
+    if memory_event and ret == 2 and time.time() - EVENTS['refreshed'] >= MEMORY_EVENT_REFRESH:
+        EVENTS['refreshed'] = time.time()
+        ret = 3
+    return ret
+
+def rebuild_columns():
+    del COLUMNS[:]
+    for col in CONFIGURATION['columns']+COLUMNS_MANDATORY:
+        COLUMNS.append(COLUMNS_AVAILABLE[col])
+    rebuild_read_plan()
+
+def rebuild_read_plan():
+    '''
+    Only read the controller files needed by the visible columns, the sort
+    column and the enabled features.
+    '''
+    READ_PLAN.clear()
+    for col in COLUMNS_AVAILABLE.values():
+        if col in COLUMNS or col.col_sort == CONFIGURATION['sort_by']:
+            READ_PLAN.update(col.col_deps)
+
+    if CONFIGURATION['psi_alert']:
+        READ_PLAN.update(resource + '.pressure' for resource in PRESSURE_RESOURCES)
+
+    # OOM and memory limit notifications, whether the 'oom' column is
+    # displayed or not
+    if CONFIGURATION['notify']:
+        READ_PLAN.add('memory.oom_control')
+
+    if CONFIGURATION['export_folded']:
+        READ_PLAN.update(['cpuacct.usage_user', 'cpuacct.usage_sys'])
+
+    if CONFIGURATION['details']:
+        READ_PLAN.update(['blkio.throttle.io_service_bytes', 'blkio.throttle.io_serviced', 'cpuacct.usage_user', 'cpuacct.usage_sys'])
+
+def diagnose():
+    devnull = open(os.devnull, 'w')
+    if os.path.isfile('/.dockerenv'):
+        print("""
+Hint: It seems you are running inside a Docker container.
       Please make sure to expose host's cgroups with
       '--volume=/sys/fs/cgroup:/sys/fs/cgroup:ro'""", file=sys.stderr)
 
@@ -971,45 +2561,874 @@ def init_screen():
         except:
             pass
 
+## Rules
+
+def rule_test(field, compare, reference, factor):
+    '''
+    Build a closure testing ``compare(line[field], reference * factor)``.
+    ``reference`` is either a number or the name of another field.
+    '''
+    if isinstance(reference, float):
+        threshold = reference * factor
+        def test(line):
+            value = line.get(field)
+            return isinstance(value, NUMBERS) and compare(value, threshold)
+    else:
+        def test(line):
+            value, limit = line.get(field), line.get(reference)
+            return isinstance(value, NUMBERS) and isinstance(limit, NUMBERS) and compare(value, limit * factor)
+    return test
+
+def compile_rule(text):
+    '''
+    Compile a rule like ``[name:] <field> <op> <number|field> [for <duration>]``
+    where op is one of >, >=, <, <=, ==, != or 'near'. Fields are the raw
+    figures of ``built_samples`` lines, like 'cpu_total' or
+    'memory_cur_percent'. Examples:
+
+      cpu_total > 0.9 for 30s
+      memory_cur_percent > 0.95
+      pids.current near pids.max
+    '''
+    match = RULE_REGEXP.match(text)
+    if not match:
+        raise ValueError("Invalid rule: " + text)
+
+    field = RULE_ALIASES.get(match.group('field'), match.group('field'))
+    op = match.group('op')
+    compare = RULE_OPERATORS[op]
+    try:
+        reference = float(match.group('reference'))
+    except ValueError:
+        reference = RULE_ALIASES.get(match.group('reference'), match.group('reference'))
+
+    # Once fired, a rule holds until the value gets past a relaxed threshold
+    factor = RULE_NEAR if op == 'near' else 1.0
+    if op in ('>', '>=', 'near'):
+        hold_factor = factor * (1 - RULE_HYSTERESIS)
+    elif op in ('<', '<='):
+        hold_factor = factor * (1 + RULE_HYSTERESIS)
+    else:
+        hold_factor = factor
+
+    duration = 0
+    if match.group('duration'):
+        duration = float(match.group('duration')) * RULE_UNITS[match.group('unit')]
+
+    # Against another field, the threshold applies to the ratio of both
+    return Rule(
+        name=match.group('name') or text.strip(),
+        field=field,
+        reference=None if isinstance(reference, float) else reference,
+        op='>=' if op == 'near' else op,
+        threshold=reference * factor if isinstance(reference, float) else factor,
+        hold_threshold=reference * hold_factor if isinstance(reference, float) else hold_factor,
+        fire=rule_test(field, compare, reference, factor),
+        hold=rule_test(field, compare, reference, hold_factor),
+        duration=duration,
+    )
+
+def load_rules(path):
+    '''
+    Compile rules from ``path``, one per line. Empty lines and lines starting
+    with '#' are ignored.
+    '''
+    rules = []
+    with open(path) as f:
+        for lineno, text in enumerate(f, 1):
+            text = text.strip()
+            if not text or text.startswith('#'):
+                continue
+            try:
+                rules.append(compile_rule(text))
+            except ValueError as e:
+                raise ValueError("%s:%d: %s" % (path, lineno, e))
+    return rules
+
+def rule_groups(rules):
+    '''
+    Group ordering ``rules`` by field, or pair of fields, then by operator.
+    Rules of a comparison are sorted by threshold, with their fire and hold
+    thresholds in the same order: the rules a value matches are a range of
+    them, found by bisection. Other rules make a group of their own.
+    '''
+    keys, groups = {}, []
+    for number, rule in enumerate(rules):
+        key = (rule.field, rule.reference) if rule.op in RULE_FLIPPED else number
+        if key not in keys:
+            keys[key] = len(groups)
+            groups.append((rule.field, rule.reference, {}))
+        groups[keys[key]][2].setdefault(rule.op, []).append(number)
+
+    result = []
+    for field, reference, operators in groups:
+        comparisons = []
+        floor, ceiling = float('inf'), float('-inf')
+        for op, numbers in sorted(operators.items()):
+            if op not in RULE_FLIPPED:
+                rule = rules[numbers[0]]
+                comparisons.append(RuleComparison(op, numbers, None, None, (rule.fire, rule.hold)))
+                floor, ceiling = float('-inf'), float('inf')
+                continue
+            numbers.sort(key=lambda number: rules[number].threshold)
+            thresholds = [rules[number].threshold for number in numbers]
+            holds = [rules[number].hold_threshold for number in numbers]
+            comparisons.append(RuleComparison(op, numbers, thresholds, holds, None))
+            # Values out of [ceiling, floor] cannot match any rule of the group
+            if op in ('>', '>='):
+                floor = min(floor, thresholds[0], holds[0])
+            else:
+                ceiling = max(ceiling, thresholds[-1], holds[-1])
+        result.append(RuleGroup(field, reference, comparisons, floor, ceiling))
+    return result
+
+def rule_candidates(group, results, fields):
+    '''
+    Return (line, value, limit) for the lines of ``results`` which may match
+    a rule of ``group``, limit being the reference field or None. ``fields``
+    caches the values of each field across groups.
+    '''
+    field, reference, floor, ceiling = group.field, group.reference, group.floor, group.ceiling
+    for name in (field, reference):
+        if name is not None and name not in fields:
+            fields[name] = [line.get(name) for line in results]
+
+    values = fields[field]
+    if reference is None:
+        return [(line, value, None) for line, value in zip(results, values)
+                if isinstance(value, NUMBERS) and not ceiling < value < floor]
+
+    limits = fields[reference]
+    return [(line, value, limit) for line, value, limit in zip(results, values, limits)
+            if isinstance(value, NUMBERS) and isinstance(limit, NUMBERS)
+            and (limit <= 0 or not ceiling < value / float(limit) < floor)]
+
+def rule_range(op, thresholds, value):
+    '''
+    Return the range of sorted ``thresholds`` that ``value`` passes with ``op``.
+    '''
+    if op == '>':
+        return 0, bisect.bisect_left(thresholds, value)
+    if op == '>=':
+        return 0, bisect.bisect_right(thresholds, value)
+    if op == '<':
+        return bisect.bisect_right(thresholds, value), len(thresholds)
+    return bisect.bisect_left(thresholds, value), len(thresholds)
+
+def rule_spans(group, line, value, limit):
+    '''
+    Return, per comparison of ``group``, the ranges of its rules ``line``
+    fires and holds as (fire start, fire end, hold start, hold end), or None
+    when it matches none of them. Fired rules hold while either matches.
+    '''
+    spans = []
+    matched = False
+    for op, numbers, thresholds, holds, tests in group.comparisons:
+        if tests is not None:
+            fire = int(tests[0](line))
+            span = (0, fire, 0, int(fire or tests[1](line)))
+        elif limit is not None and limit == 0:
+            fire = len(numbers) if RULE_OPERATORS[op](value, 0.0) else 0
+            span = (0, fire, 0, fire)
+        else:
+            # Ratios to a negative reference order the other way round
+            ratio = value if limit is None else value / float(limit)
+            if limit is not None and limit < 0:
+                op = RULE_FLIPPED[op]
+            fire_start, fire_end = rule_range(op, thresholds, ratio)
+            hold_start, hold_end = rule_range(op, holds, ratio)
+            span = (fire_start, fire_end, min(fire_start, hold_start), max(fire_end, hold_end))
+        matched = matched or span[2] < span[3]
+        spans.append(span)
+    return tuple(spans) if matched else None
+
+def span_difference(start, end, other_start, other_end):
+    '''
+    Return the positions of range(start, end) out of range(other_start, other_end).
+    '''
+    if other_start >= other_end:
+        return range(start, end)
+    return list(range(start, min(end, other_start))) + list(range(max(start, other_end), end))
+
+def rule_transitions(state, group, cgroup, old, new, now, events):
+    '''
+    Update ``state`` for ``cgroup``, whose ranges of matched rules of ``group``
+    changed from ``old`` to ``new``, and append the rules it fires or resolves
+    to ``events``. Rules with a duration are pending until due.
+    '''
+    rules, pending, fired = state['rules'], state['pending'], state['fired']
+    for index, comparison in enumerate(group.comparisons):
+        before = old[index] if old else RULE_NO_SPAN
+        after = new[index] if new else RULE_NO_SPAN
+        if before == after:
+            continue
+
+        for position in span_difference(after[0], after[1], before[0], before[1]):
+            key = (comparison.numbers[position], cgroup)
+            rule = rules[key[0]]
+            if key in fired:
+                continue
+            if rule.duration:
+                pending[key] = now
+                heapq.heappush(state['due'], (now + rule.duration, now, key[0], cgroup))
+            else:
+                fired.add(key)
+                events.append({'time': now, 'rule': rule.name, 'cgroup': cgroup, 'state': 'firing'})
+
+        for position in span_difference(before[0], before[1], after[0], after[1]):
+            pending.pop((comparison.numbers[position], cgroup), None)
+
+        for position in span_difference(before[2], before[3], after[2], after[3]):
+            key = (comparison.numbers[position], cgroup)
+            if key in fired:
+                fired.remove(key)
+                events.append({'time': now, 'rule': rules[key[0]].name, 'cgroup': cgroup, 'state': 'resolved'})
+
+def evaluate_rules(rules, results, state, now):
+    '''
+    Evaluate compiled ``rules`` against ``results``. A rule fires once it
+    matched for its whole duration, and resolves once it does not hold
+    anymore. Return the list of transitions.
+
+    ``state`` is updated in place. It keeps, per group, the values of the
+    cgroups which may match and the ranges of rules they matched: only the
+    cgroups whose ranges changed since the previous call are looked at, and
+    only for the rules entering or leaving them.
+    '''
+    if state.get('rules') is not rules:
+        state.clear()
+        state.update({'rules': rules, 'groups': rule_groups(rules), 'pending': {}, 'fired': set(), 'due': []})
+        state['spans'] = [{} for _ in state['groups']]
+
+    events = []
+    fields = {}
+    for index, group in enumerate(state['groups']):
+        previous, current = state['spans'][index], {}
+        for line, value, limit in rule_candidates(group, results, fields):
+            cgroup = line['cgroup']
+            old = previous.get(cgroup, RULE_NO_MATCH)
+            if old[0] == value and old[1] == limit:
+                current[cgroup] = old
+                continue
+            spans = rule_spans(group, line, value, limit)
+            current[cgroup] = (value, limit, spans)
+            if spans != old[2]:
+                rule_transitions(state, group, cgroup, old[2], spans, now, events)
+        for cgroup in set(previous).difference(current):
+            if previous[cgroup][2] is not None:
+                rule_transitions(state, group, cgroup, previous[cgroup][2], None, now, events)
+        state['spans'][index] = current
+
+    # Pending rules still matching once due fire
+    due, pending = state['due'], state['pending']
+    while due and due[0][0] <= now:
+        _, since, number, cgroup = heapq.heappop(due)
+        if pending.get((number, cgroup)) == since:
+            del pending[(number, cgroup)]
+            state['fired'].add((number, cgroup))
+            events.append({'time': now, 'rule': rules[number].name, 'cgroup': cgroup, 'state': 'firing'})
+
+    return events
+
+def emit_event(event, hook):
+    '''
+    Print ``event`` as a JSON line, or pass it to the ``hook`` shell command
+    in CTOP_RULE, CTOP_CGROUP, CTOP_STATE and CTOP_TIME environment variables.
+    '''
+    if not hook:
+        print(json.dumps(event, sort_keys=True))
+        sys.stdout.flush()
+        return
+
+    env = dict(os.environ)
+    env.update({
+        'CTOP_RULE': event['rule'],
+        'CTOP_CGROUP': event['cgroup'],
+        'CTOP_STATE': event['state'],
+        'CTOP_TIME': str(event['time']),
+    })
+    with open('/dev/null', 'w') as dev_null:
+        subprocess.Popen(hook, shell=True, env=env, stdout=dev_null, stderr=dev_null, close_fds=True)
+
+def watch_rules(measures, rules, hook):
+    '''
+    Headless mode. Collect every refresh interval and evaluate ``rules``
+    against each sample.
+    '''
+    state = {}
+    try:
+        while True:
+            start = time.time()
+            collect(measures)
+            for event in evaluate_rules(rules, built_statistics(measures, CONFIGURATION), state, start):
+                emit_event(event, hook)
+            time.sleep(max(0, start + CONFIGURATION['refresh_interval'] - time.time()))
+    except KeyboardInterrupt:
+        pass
+
+## Agent mode
+
+def parse_address(address):
+    '''
+    Parse a ``host[:port]`` or ``/path/to/unix.sock`` address into a socket
+    family and address
+    '''
+    if '/' in address:
+        return socket.AF_UNIX, address
+    if ':' not in address:
+        return socket.AF_INET, (address, AGENT_PORT)
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+def encode_sample(sample):
+    '''
+    Encode one sample as a JSON line
+    '''
+    return (json.dumps(sample, separators=(',', ':')) + '\n').encode('utf-8')
+
+class AgentClient(object):
+    '''
+    Connection from a ``ctop --connect`` client. Samples are queued, then
+    sent without blocking as the socket accepts them, so that slow clients
+    do not hold collection.
+    '''
+    def __init__(self, sock, state):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.chunks = deque([state])
+        self.offset = 0     # sent bytes of the first chunk
+        self.queued = len(state)
+        self.limit = len(state) + AGENT_BACKLOG
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def queue(self, data):
+        '''
+        Queue encoded sample ``data``. Return False if the client is too far
+        behind.
+        '''
+        self.chunks.append(data)
+        self.queued += len(data)
+        return self.queued <= self.limit
+
+    def flush(self):
+        '''
+        Send queued data until the socket would block. Return False if the
+        client is gone.
+        '''
+        while self.chunks:
+            chunk = self.chunks[0]
+            try:
+                sent = self.sock.send(chunk[self.offset:self.offset + AGENT_SEND_SIZE])
+            except socket.error as e:
+                return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+            self.offset += sent
+            self.queued -= sent
+            if self.offset == len(chunk):
+                self.chunks.popleft()
+                self.offset = 0
+        return True
+
+    def close(self):
+        self.sock.close()
+        self.closed = True
+
+def delta(prev, line):
+    '''
+    Fields of sample ``line`` that changed since ``prev``. Dict fields, like
+    per device figures, only carry the keys that changed, None marking
+    removed keys.
+    '''
+    changed = {}
+    for key, value in line.items():
+        old = prev.get(key)
+        if value == old:
+            continue
+        if isinstance(value, dict) and isinstance(old, dict):
+            value = dict((k, v) for k, v in value.items() if old.get(k) != v)
+            value.update((k, None) for k in old if k not in line[key])
+        changed[key] = value
+    return changed
+
+def apply_delta(line, changed):
+    '''
+    Update sample ``line`` in place with ``changed`` fields, see ``delta``
+    '''
+    for key, value in changed.items():
+        old = line.get(key)
+        if not (isinstance(value, dict) and isinstance(old, dict)):
+            line[key] = value
+            continue
+        for k, v in value.items():
+            if v is None:
+                old.pop(k, None)
+            else:
+                old[k] = v
+
+def agent(measures, address):
+    '''
+    Headless mode. Collect every refresh interval and stream samples to
+    connected ``ctop --connect`` clients. Clients first get the full state,
+    then only the fields that changed since the previous sample. Samples are
+    sent while waiting for the next refresh.
+    '''
+    family, sockaddr = parse_address(address)
+    if family == socket.AF_UNIX and os.path.exists(sockaddr) and stat.S_ISSOCK(os.stat(sockaddr).st_mode):
+        os.unlink(sockaddr)
+
+    server = socket.socket(family, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(sockaddr)
+    server.listen(16)
+
+    clients = []
+    state = {}
+    try:
+        while True:
+            collect(measures)
+            cur_time = time.time()
+
+            # Delta encode
+            updates = {}
+            for line in built_samples(measures):
+                cgroup = line.pop('cgroup')
+                for key in BULKY_FIELDS:
+                    line.pop(key, None)
+                for key, value in line.items():
+                    if isinstance(value, float):
+                        line[key] = round(value, 4)
+
+                changed = delta(state.get(cgroup, {}), line)
+                if changed:
+                    updates[cgroup] = changed
+                state[cgroup] = line
+
+            removed = [cgroup for cgroup in state if cgroup not in measures['data']]
+            for cgroup in removed:
+                del state[cgroup]
+
+            data = encode_sample({'t': cur_time, 'u': updates, 'd': removed})
+            for client in clients:
+                if not client.queue(data):
+                    client.close()
+            clients = [client for client in clients if not client.closed]
+
+            # Send samples and accept new clients until next refresh
+            while time.time() < cur_time + CONFIGURATION['refresh_interval']:
+                timeout = cur_time + CONFIGURATION['refresh_interval'] - time.time()
+                try:
+                    readable, writable, _ = select.select([server], [client for client in clients if client.chunks], [], max(timeout, 0))
+                except select.error as e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    continue
+
+                for client in writable:
+                    if not client.flush():
+                        client.close()
+                clients = [client for client in clients if not client.closed]
+
+                if readable:
+                    sock, _ = server.accept()
+                    clients.append(AgentClient(sock, encode_sample({'t': cur_time, 'u': state, 'd': []})))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for client in clients:
+            client.close()
+        server.close()
+        if family == socket.AF_UNIX:
+            os.unlink(sockaddr)
+
+## Snapshots
+
+def snapshot(measures, path):
+    '''
+    Headless mode. Collect twice, one refresh interval apart, and save one
+    line per cgroup to ``path``. Rates are averaged over the interval.
+
+    Lines are tab separated: cgroup, CPU usage, memory, BlockIO bandwidth and
+    tasks count, for ``ctop diff`` to skip JSON decoding, then the full
+    sample as JSON.
+    '''
+    collect(measures)
+    time.sleep(CONFIGURATION['refresh_interval'])
+    collect(measures)
+
+    with open(path, 'w') as f:
+        for line in built_samples(measures):
+            for key in BULKY_FIELDS:
+                line.pop(key, None)
+            f.write('\t'.join([
+                line['cgroup'],
+                repr(line['cpu_syst'] + line['cpu_user']),
+                str(line['memory_cur_bytes']),
+                repr(line['blkio_bw_bytes']),
+                str(line['cur_tasks']),
+                json.dumps(line, separators=(',', ':')),
+            ]) + '\n')
+
+def read_snapshot(path):
+    '''
+    Generator of (cgroup, [cpu, memory, blkio, tasks]) from snapshot ``path``,
+    figures left as text for ``DIFF_COLUMNS`` to parse
+    '''
+    with open(path) as f:
+        for line in f:
+            fields = line.split('\t', 5)
+            if len(fields) != 6:
+                raise ValueError("%s: truncated line %r" % (path, line))
+            yield fields[0], fields[1:5]
+
+def diff_snapshots(before_path, after_path, key):
+    '''
+    Join two snapshots by cgroup path, in a single pass over each: index the
+    first one, then stream the second one against it. Generator of (change
+    of figure ``key``, cgroup, state, figures after, figures before), state
+    being '+' for new cgroups, '-' for removed ones. Only figure ``key`` is
+    parsed, the others are left as text.
+    '''
+    parse = DIFF_COLUMNS[key][2]
+    before = dict(read_snapshot(before_path))
+    for cgroup, after in read_snapshot(after_path):
+        figures = before.pop(cgroup, None)
+        if figures is None:
+            yield abs(parse(after[key])), cgroup, '+', after, None
+        else:
+            yield abs(parse(after[key]) - parse(figures[key])), cgroup, ' ', after, figures
+
+    for cgroup, figures in before.items():
+        yield abs(parse(figures[key])), cgroup, '-', None, figures
+
+def print_diff(before_path, after_path, sort_by, rows):
+    '''
+    Print the ``rows`` cgroups with the largest change of ``sort_by`` between
+    two snapshots, or all of them if ``rows`` is 0
+    '''
+    key = DIFF_SORT[sort_by]
+    changes = diff_snapshots(before_path, after_path, key)
+    if rows:
+        changes = heapq.nlargest(rows, changes, key=operator.itemgetter(0))
+    else:
+        changes = sorted(changes, key=operator.itemgetter(0), reverse=True)
+
+    row = ' '.join('{%d:>%d}' % (i, width) for i, (_, width, _, _) in enumerate(DIFF_COLUMNS)) + ' {4} {5}\n'
+    parses = [parse for _, _, parse, _ in DIFF_COLUMNS]
+    formats = [fmt for _, _, _, fmt in DIFF_COLUMNS]
+    out = [row.format(*([title for title, _, _, _ in DIFF_COLUMNS] + [' ', 'CGROUP']))]
+    for _, cgroup, state, after, before in changes:
+        if before is None:
+            deltas = [parse(value) for parse, value in zip(parses, after)]
+        elif after is None:
+            deltas = [-parse(old) for parse, old in zip(parses, before)]
+        else:
+            deltas = [parse(value) - parse(old) for parse, value, old in zip(parses, after, before)]
+        out.append(row.format(*([fmt(delta) for fmt, delta in zip(formats, deltas)] + [state, cgroup])))
+    sys.stdout.write(''.join(out))
+
+class RemoteHost(object):
+    '''
+    Connection to a ``ctop --agent``. Keeps a copy of its latest samples and
+    reconnects when the agent restarts. Connections are non-blocking, so that
+    unreachable agents do not hold the display.
+    '''
+    def __init__(self, address):
+        self.address = address
+        self.name = os.path.basename(address) if '/' in address else address
+        self.sock = None
+        self.connected = False
+        self.deadline = 0       # pending connection timeout
+        self.retry_at = 0
+        self.backoff = AGENT_RETRY_MIN
+        self.buffer = b''
+        self.lines = {}
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def connect(self):
+        '''
+        Start connecting, unless waiting before the next attempt
+        '''
+        now = time.time()
+        if now < self.retry_at:
+            return
+
+        family, sockaddr = parse_address(self.address)
+        try:
+            if family != socket.AF_UNIX:
+                family, _, _, _, sockaddr = socket.getaddrinfo(sockaddr[0], sockaddr[1], 0, socket.SOCK_STREAM)[0]
+            self.sock = socket.socket(family, socket.SOCK_STREAM)
+            self.sock.setblocking(False)
+            error = self.sock.connect_ex(sockaddr)
+        except socket.error:
+            error = errno.ECONNREFUSED
+
+        if error in (0, errno.EISCONN):
+            self.connected = True
+            self.backoff = AGENT_RETRY_MIN
+        elif error == errno.EINPROGRESS:
+            self.deadline = now + AGENT_CONNECT_TIMEOUT
+        else:
+            self.retry()
+
+    def connecting(self, writable):
+        '''
+        Complete a pending connection once its socket is ``writable``, or
+        give up past the deadline
+        '''
+        if writable:
+            if self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                self.retry()
+            else:
+                self.connected = True
+                self.backoff = AGENT_RETRY_MIN
+        elif time.time() >= self.deadline:
+            self.retry()
+
+    def retry(self):
+        '''
+        Drop the connection attempt, try again after the backoff delay
+        '''
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.retry_at = time.time() + self.backoff
+        self.backoff = min(self.backoff * 2, AGENT_RETRY_MAX)
+
+    def disconnect(self):
+        self.sock.close()
+        self.sock = None
+        self.connected = False
+        self.buffer = b''
+        self.lines = {}
+
+    def receive(self):
+        '''
+        Read and apply all pending samples
+        '''
+        try:
+            data = self.sock.recv(64 * 1024)
+        except socket.error:
+            data = b''
+
+        if not data:
+            self.disconnect()
+            return
+
+        self.buffer += data
+        while b'\n' in self.buffer:
+            sample, self.buffer = self.buffer.split(b'\n', 1)
+            sample = json.loads(sample.decode('utf-8'))
+            for cgroup, fields in sample['u'].items():
+                apply_delta(self.lines.setdefault(cgroup, {}), fields)
+            for cgroup in sample['d']:
+                self.lines.pop(cgroup, None)
+
+def collect_remotes(remotes):
+    '''
+    Apply pending samples from all agents and merge them into a single result
+    list. Cgroups paths are prefixed by the host name.
+    '''
+    for remote in remotes:
+        if remote.sock is None:
+            remote.connect()
+
+    pending = [remote for remote in remotes if remote.sock is not None and not remote.connected]
+    if pending:
+        _, writable, _ = select.select([], pending, [], 0)
+        for remote in pending:
+            remote.connecting(remote in writable)
+
+    connected = [remote for remote in remotes if remote.connected]
+    while connected:
+        readable, _, _ = select.select(connected, [], [], 0)
+        if not readable:
+            break
+        for remote in readable:
+            remote.receive()
+        connected = [remote for remote in connected if remote.connected]
+
+    results = []
+    regex = CONFIGURATION['search_regex']
+    for remote in remotes:
+        for cgroup, fields in remote.lines.items():
+            if regex is not None and cgroup != '/' and not regex.search(cgroup):
+                continue
+            line = dict(fields)
+            line['host'] = remote.name
+            line['cgroup'] = '/' + remote.name + (cgroup if cgroup != '/' else '')
+            results.append(decorate_line(line))
+    return results
+
+def display_loop(measures):
+    '''
+    Interactive mode. Collect, or receive from agents, and display every
+    refresh interval, handling input and kernel notifications in between.
+    '''
+    results = None
+
+    # Kernel notifications are only waited on by the interactive display
+    CONFIGURATION['notify'] = True
+    rebuild_read_plan()
+
+    try:
+        # Curse initialization
+        stdscr = curses.initscr()
+        init_screen()
+        stdscr.keypad(1)     # parse keypad control sequences
+
+        # Curses colors
+        curses.init_pair(1, curses.COLOR_BLACK, curses.COLOR_GREEN) # header
+        curses.init_pair(2, curses.COLOR_BLACK, curses.COLOR_CYAN)  # focused header / line
+        curses.init_pair(3, curses.COLOR_WHITE, -1)  # regular
+        curses.init_pair(4, curses.COLOR_CYAN,  -1)  # tree
+        curses.init_pair(5, curses.COLOR_WHITE, curses.COLOR_RED)  # alert
+
+        # Main loop
+        while True:
+            if CONFIGURATION['remotes']:
+                results = collect_remotes(CONFIGURATION['remotes'])
+            else:
+                collect(measures)
+                results = built_statistics(measures, CONFIGURATION)
+            display(stdscr, results, CONFIGURATION)
+            sleep_start = time.time()
+            while CONFIGURATION['pause_refresh'] or time.time() < sleep_start + CONFIGURATION['refresh_interval']:
+                if CONFIGURATION['pause_refresh']:
+                    to_sleep = -1
+                else:
+                    to_sleep = int((sleep_start + CONFIGURATION['refresh_interval'] - time.time())*1000)
+                ret = wait_events(stdscr, to_sleep)
+                if ret == 2:
+                    display(stdscr, results, CONFIGURATION)
+                elif ret == 3:
+                    break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        curses.nocbreak()
+        stdscr.keypad(0)
+        curses.echo()
+        curses.endwin()
+
+    # If we found only root cgroup, me may be expecting to run in a boot2docker instance
+    if results is not None and len(results) < 2 and not CONFIGURATION['remotes']:
+        print("[WARN] Failed to find any relevant cgroup/container.", file=sys.stderr)
+        diagnose()
+
+def on_terminate(signum, frame):
+    '''
+    Stop on SIGTERM like on Ctrl-C, for captures to be flushed
+    '''
+    raise KeyboardInterrupt()
+
 def main():
     # Parse arguments
     parser = OptionParser()
     parser.add_option("--tree",     action="store_true",                default=False, help="show tree view by default")
-    parser.add_option("--refresh",  action="store",      type="int",    default=1,     help="Refresh display every <seconds>")
+    parser.add_option("--refresh",  action="store",      type="float",  default=1,     help="Refresh display every <seconds>")
     parser.add_option("--follow",   action="store",      type="string", default="",    help="Follow cgroup path")
     parser.add_option("--fold",     action="append",                                   help="Fold cgroup sub tree")
     parser.add_option("--type",     action="append",                                   help="Only show containers of this type")
     parser.add_option("--columns",  action="store",      type="string", default="owner,type,processes,memory,cpu-sys,cpu-user,blkio,cpu-time", help="List of optional columns to display. Always includes 'name'")
     parser.add_option("--sort-col", action="store",      type="string", default="cpu-user", help="Select column to sort by initially. Can be changed dynamically.")
+    parser.add_option("--cpu-budget", action="store",    type="float",  default=None,  help="Keep collection under this percentage of one CPU")
+    parser.add_option("--hide-self", action="store_true",               default=False, help="Do not monitor the cgroups ctop runs in")
+    parser.add_option("--psi-alert", action="store_true",               default=False, help="Highlight cgroups as soon as the kernel reports a pressure stall")
+    parser.add_option("--agent",    action="store_true",                default=False, help="Do not display anything, stream samples to 'ctop --connect' clients")
+    parser.add_option("--listen",   action="store",      type="string", default="",    help="Agent address, <host>:<port> or unix socket path")
+    parser.add_option("--connect",  action="store",      type="string", default="",    help="Display samples from a comma separated list of agents")
+    parser.add_option("--rules",    action="store",      type="string", default="",    help="Do not display anything, evaluate alert rules from this file")
+    parser.add_option("--rules-hook", action="store",    type="string", default="",    help="Run this command on alerts instead of printing them")
+    parser.add_option("--root",     action="store",      type="string", default="/",   help="Only monitor the cgroup sub-tree at this path")
+    parser.add_option("--snapshot", action="store",      type="string", default="",    help="Do not display anything, save figures to this file for 'ctop diff'")
+    parser.add_option("--rows",     action="store",      type="int",    default=50,    help="Only list this many cgroups with 'ctop diff', 0 for all")
+    parser.add_option("--export-folded", action="store", type="string", default="",   help="Write CPU time per cgroup to this file, in folded stack format")
+    parser.add_option("--plugin",   action="append",                                   help="Load plugin from this file")
+    parser.add_option("--mounts",   action="store",      type="string", default="/proc/mounts", help="Read cgroup mountpoints from this file")
 
     options, args = parser.parse_args()
 
+    if args and args[0] == 'diff':
+        if len(args) != 3:
+            print("Usage: ctop diff <before> <after>", file=sys.stderr)
+            sys.exit(1)
+        if options.sort_col not in COLUMNS_AVAILABLE or COLUMNS_AVAILABLE[options.sort_col].col_sort not in DIFF_SORT:
+            print("Invalid sort column name", options.sort_col, file=sys.stderr)
+            print(__doc__)
+            sys.exit(1)
+        try:
+            print_diff(args[1], args[2], COLUMNS_AVAILABLE[options.sort_col].col_sort, options.rows)
+        except (IOError, ValueError) as e:
+            print("Invalid snapshot:", e, file=sys.stderr)
+            sys.exit(1)
+        return
+
     CONFIGURATION['tree'] = options.tree
     CONFIGURATION['refresh_interval'] = float(options.refresh)
     CONFIGURATION['columns'] = []
     CONFIGURATION['fold'] = options.fold or list()
     CONFIGURATION['type'] = options.type or list()
+    CONFIGURATION['psi_alert'] = options.psi_alert
+    CONFIGURATION['root'] = options.root
+    CONFIGURATION['cpu_budget'] = options.cpu_budget
+    CONFIGURATION['hide_self'] = options.hide_self
+    CONFIGURATION['export_folded'] = options.export_folded or None
 
     if options.follow:
         CONFIGURATION['selected_line_name'] = options.follow
         CONFIGURATION['follow'] = True
 
+    if options.agent and not options.listen:
+        print("Agent mode requires a --listen address", file=sys.stderr)
+        print(__doc__)
+        sys.exit(1)
+
+    try:
+        load_plugins(options.plugin or [])
+    except (IOError, ValueError) as e:
+        print("Failed to load plugin:", e, file=sys.stderr)
+        sys.exit(1)
+
+    if options.connect:
+        CONFIGURATION['remotes'] = [RemoteHost(address.strip()) for address in options.connect.split(',')]
+        CONFIGURATION['columns'].append('host')
+
     for col in options.columns.split(','):
         col = col.strip()
-        if col in COLUMNS_MANDATORY:
+        if col in COLUMNS_MANDATORY or col in CONFIGURATION['columns']:
             continue
         if not col in COLUMNS_AVAILABLE:
             print("Invalid column name", col, file=sys.stderr)
             print(__doc__)
             sys.exit(1)
         CONFIGURATION['columns'].append(col)
-    rebuild_columns()
+
+    # Rows are not all refreshed at once
+    if options.cpu_budget is not None and not options.connect and 'age' not in CONFIGURATION['columns']:
+        CONFIGURATION['columns'].append('age')
+
+    if options.rules:
+        try:
+            rules = load_rules(options.rules)
+        except (IOError, ValueError) as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+
+    # Agents do not know which columns their clients will display, rules and
+    # snapshots may use any figure
+    if options.agent or options.rules or options.snapshot:
+        CONFIGURATION['columns'] = [col for col in COLUMNS_AVAILABLE if col not in COLUMNS_MANDATORY]
 
     if options.sort_col not in COLUMNS_AVAILABLE:
         print("Invalid sort column name", options.sort_col, file=sys.stderr)
         print(__doc__)
         sys.exit(1)
     CONFIGURATION['sort_by'] = COLUMNS_AVAILABLE[options.sort_col].col_sort
+    rebuild_columns()
 
     # Initialization, global system data
     measures = {
@@ -1017,57 +3436,32 @@ def main():
         'global': {
             'total_cpu': multiprocessing.cpu_count(),
             'total_memory': get_total_memory(),
-            'scheduler_frequency': os.sysconf('SC_CLK_TCK'),
         }
     }
 
-    init()
-
-    if not CGROUP_MOUNTPOINTS:
-        print("[ERROR] Failed to locate cgroup mountpoints.", file=sys.stderr)
-        diagnose()
-        sys.exit(1)
+    if not CONFIGURATION['remotes']:
+        init(options.mounts)
+        CONFIGURATION['self'] = own_cgroups()
 
-    results = None
+        if not CGROUP_MOUNTPOINTS:
+            print("[ERROR] Failed to locate cgroup mountpoints.", file=sys.stderr)
+            diagnose()
+            sys.exit(1)
 
+    signal.signal(signal.SIGTERM, on_terminate)
     try:
-        # Curse initialization
-        stdscr = curses.initscr()
-        init_screen()
-        stdscr.keypad(1)     # parse keypad control sequences
-
-        # Curses colors
-        curses.init_pair(1, curses.COLOR_BLACK, curses.COLOR_GREEN) # header
-        curses.init_pair(2, curses.COLOR_BLACK, curses.COLOR_CYAN)  # focused header / line
-        curses.init_pair(3, curses.COLOR_WHITE, -1)  # regular
-        curses.init_pair(4, curses.COLOR_CYAN,  -1)  # tree
-
-        # Main loop
-        while True:
-            collect(measures)
-            results = built_statistics(measures, CONFIGURATION)
-            display(stdscr, results, CONFIGURATION)
-            sleep_start = time.time()
-            while CONFIGURATION['pause_refresh'] or time.time() < sleep_start + CONFIGURATION['refresh_interval']:
-                if CONFIGURATION['pause_refresh']:
-                    to_sleep = -1
-                else:
-                    to_sleep = int((sleep_start + CONFIGURATION['refresh_interval'] - time.time())*1000)
-                ret = event_listener(stdscr, to_sleep)
-                if ret == 2:
-                    display(stdscr, results, CONFIGURATION)
-    except KeyboardInterrupt:
-        pass
+        if options.agent:
+            agent(measures, options.listen)
+        elif options.rules:
+            watch_rules(measures, rules, options.rules_hook)
+        elif options.snapshot:
+            snapshot(measures, options.snapshot)
+        else:
+            display_loop(measures)
     finally:
-        curses.nocbreak()
-        stdscr.keypad(0)
-        curses.echo()
-        curses.endwin()
-
-    # If we found only root cgroup, me may be expecting to run in a boot2docker instance
-    if results is not None and len(results) < 2:
-        print("[WARN] Failed to find any relevant cgroup/container.", file=sys.stderr)
-        diagnose()
+        # End of capture, however it ended
+        if CONFIGURATION['export_folded'] and not CONFIGURATION['remotes']:
+            write_folded(CONFIGURATION['export_folded'])
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,40 @@
+'''
+Fake cgroup v1 hierarchies in a temporary directory, mounted through the
+``--mounts`` hook
+'''
+import os
+import shutil
+import tempfile
+
+def make_tree(controllers, cgroups):
+    '''
+    Create a hierarchy per controller under a temporary directory. Return
+    (directory, mounts file). ``cgroups`` maps short paths to {file: content},
+    written in every hierarchy.
+    '''
+    root = tempfile.mkdtemp(prefix='ctop-')
+    mounts = []
+    for controller in controllers:
+        base = os.path.join(root, controller)
+        for short_path, files in cgroups.items():
+            path = os.path.join(base, short_path.lstrip('/'))
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            for name, content in files.items():
+                with open(os.path.join(path, name), 'w') as f:
+                    f.write(content)
+        mounts.append('cgroup %s cgroup rw,%s 0 0' % (base, controller))
+
+    mounts_file = os.path.join(root, 'mounts')
+    with open(mounts_file, 'w') as f:
+        f.write('\n'.join(mounts) + '\n')
+    return root, mounts_file
+
+def remove_tree(root):
+    shutil.rmtree(root, ignore_errors=True)
+
+def tasks(count, first=1000):
+    '''
+    Content of a tasks or cgroup.procs file listing ``count`` IDs
+    '''
+    return ''.join('%d\n' % pid for pid in range(first, first + count))
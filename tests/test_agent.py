@@ -0,0 +1,76 @@
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cgroup_top
+from fixture import make_tree, remove_tree, tasks
+
+def busy_cgroup(memory, devices):
+    return {
+        'cgroup.procs': tasks(1), 'tasks': tasks(2),
+        'cpuacct.usage': '1000\n', 'cpuacct.usage_user': '600\n', 'cpuacct.usage_sys': '400\n',
+        'memory.usage_in_bytes': '%d\n' % memory, 'memory.stat': 'cache 0\nrss %d\n' % memory,
+        'memory.limit_in_bytes': '%d\n' % (1 << 30),
+        'blkio.throttle.io_service_bytes': ''.join('%s Read 100\n%s Write 200\n' % (device, device) for device in devices),
+        'blkio.throttle.io_serviced': ''.join('%s Read 1\n%s Write 2\n' % (device, device) for device in devices),
+    }
+
+class TestAgents(unittest.TestCase):
+    '''
+    Samples streamed by agents on two hosts are merged by a client, which
+    keeps up with the fields they change, down to single keys of dict fields
+    '''
+    def setUp(self):
+        self.trees, self.agents, self.remotes = [], [], []
+        for name, cgroup in [('a', '/web'), ('b', '/db')]:
+            root, mounts = make_tree(['cpuacct', 'memory', 'blkio'], {
+                '/': {'cgroup.procs': tasks(1), 'tasks': tasks(1)},
+                cgroup: busy_cgroup(4096, ['8:0', '8:16']),
+            })
+            address = os.path.join(root, name + '.sock')
+            self.trees.append(root)
+            with open(os.devnull, 'w') as dev_null:
+                self.agents.append(subprocess.Popen([
+                    sys.executable, cgroup_top.__file__, '--agent', '--listen=' + address,
+                    '--refresh=0.2', '--mounts=' + mounts], stdout=dev_null, stderr=dev_null))
+            self.remotes.append(cgroup_top.RemoteHost(address))
+
+    def tearDown(self):
+        for agent in self.agents:
+            agent.terminate()
+            agent.wait()
+        for root in self.trees:
+            remove_tree(root)
+
+    def wait_lines(self, condition):
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            lines = dict((line['cgroup'], line) for line in cgroup_top.collect_remotes(self.remotes))
+            if condition(lines):
+                return lines
+            time.sleep(0.1)
+        self.fail('Agents did not send the expected samples: %r' % sorted(lines))
+
+    def test_merge(self):
+        lines = self.wait_lines(lambda lines: '/a.sock/web' in lines and '/b.sock/db' in lines)
+        self.assertEqual(lines['/a.sock/web']['host'], 'a.sock')
+        self.assertEqual(lines['/b.sock/db']['host'], 'b.sock')
+        self.assertEqual(lines['/a.sock/web']['memory_cur_bytes'], 4096)
+        self.assertEqual(sorted(lines['/a.sock/web']['blkio_devices']), ['8:0', '8:16'])
+
+    def test_nested_changes(self):
+        self.wait_lines(lambda lines: '/a.sock/web' in lines)
+        for name, content in busy_cgroup(8192, ['8:0']).items():
+            for controller in ('cpuacct', 'memory', 'blkio'):
+                with open(os.path.join(self.trees[0], controller, 'web', name), 'w') as f:
+                    f.write(content)
+
+        lines = self.wait_lines(lambda lines: lines['/a.sock/web']['memory_cur_bytes'] == 8192 and
+                                sorted(lines['/a.sock/web']['blkio_devices']) == ['8:0'])
+        self.assertEqual(sorted(lines['/b.sock/db']['blkio_devices']), ['8:0', '8:16'])
+
+if __name__ == '__main__':
+    unittest.main()
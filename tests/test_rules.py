@@ -0,0 +1,73 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cgroup_top
+
+def line(cgroup, **fields):
+    fields['cgroup'] = cgroup
+    return fields
+
+class TestRuleSyntax(unittest.TestCase):
+    def test_number_literals(self):
+        for text, threshold in [('cpu_total > -1', -1.0), ('cpu_total > 1e-3', 1e-3),
+                                ('cpu_total > .5', 0.5), ('cpu_total < +2E2', 200.0)]:
+            rule = cgroup_top.compile_rule(text)
+            self.assertEqual(rule.reference, None)
+            self.assertEqual(rule.threshold, threshold)
+
+    def test_field_reference(self):
+        rule = cgroup_top.compile_rule('limits: pids.current near pids.max for 1m')
+        self.assertEqual((rule.name, rule.field, rule.reference), ('limits', 'tree_tasks', 'max_tasks'))
+        self.assertEqual((rule.op, rule.threshold, rule.duration), ('>=', cgroup_top.RULE_NEAR, 60))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, cgroup_top.compile_rule, 'cpu_total > 1e-')
+
+class TestRuleEvaluation(unittest.TestCase):
+    '''
+    Rules fire and resolve as the figures of each cgroup cross their
+    thresholds, whatever other rules share them
+    '''
+    def setUp(self):
+        self.rules = [cgroup_top.compile_rule(text) for text in [
+            'high: cpu_total > 0.8',
+            'higher: cpu_total > 0.9 for 10s',
+            'low: cpu_total < -1e-3',
+            'limits: pids.current near pids.max',
+            'exact: cpu_total == 0.5',
+        ]]
+        self.state = {}
+
+    def evaluate(self, now, *lines):
+        events = cgroup_top.evaluate_rules(self.rules, list(lines), self.state, now)
+        return sorted((event['rule'], event['cgroup'], event['state']) for event in events)
+
+    def test_thresholds(self):
+        self.assertEqual(self.evaluate(0, line('/a', cpu_total=0.95), line('/b', cpu_total=-1)), [
+            ('high', '/a', 'firing'), ('low', '/b', 'firing')])
+        self.assertEqual(self.evaluate(5, line('/a', cpu_total=0.95), line('/b', cpu_total=0.5)), [
+            ('exact', '/b', 'firing'), ('low', '/b', 'resolved')])
+        self.assertEqual(self.evaluate(10, line('/a', cpu_total=0.95)), [
+            ('exact', '/b', 'resolved'), ('higher', '/a', 'firing')])
+
+    def test_duration_restarts(self):
+        self.assertEqual(self.evaluate(0, line('/a', cpu_total=0.95)), [('high', '/a', 'firing')])
+        self.assertEqual(self.evaluate(5, line('/a', cpu_total=0.85)), [])
+        self.assertEqual(self.evaluate(10, line('/a', cpu_total=0.95)), [])
+        self.assertEqual(self.evaluate(20, line('/a', cpu_total=0.95)), [('higher', '/a', 'firing')])
+
+    def test_hysteresis(self):
+        self.evaluate(0, line('/a', cpu_total=0.85))
+        self.assertEqual(self.evaluate(1, line('/a', cpu_total=0.77)), [])
+        self.assertEqual(self.evaluate(2, line('/a', cpu_total=0.75)), [('high', '/a', 'resolved')])
+
+    def test_ratio(self):
+        self.assertEqual(self.evaluate(0, line('/a', tree_tasks=90, max_tasks=100), line('/b', tree_tasks=90, max_tasks='max')), [
+            ('limits', '/a', 'firing')])
+        self.assertEqual(self.evaluate(1, line('/a', tree_tasks=86, max_tasks=100)), [])
+        self.assertEqual(self.evaluate(2, line('/a', tree_tasks=86, max_tasks=200)), [('limits', '/a', 'resolved')])
+
+if __name__ == '__main__':
+    unittest.main()
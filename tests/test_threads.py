@@ -0,0 +1,72 @@
+import os
+import re
+import sys
+import unittest
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cgroup_top
+from fixture import make_tree, remove_tree, tasks
+
+def pids_cgroup(procs, threads, subtree):
+    return {'cgroup.procs': tasks(procs), 'tasks': tasks(threads), 'pids.current': '%d\n' % subtree, 'pids.max': 'max\n'}
+
+class TestThreadsScope(unittest.TestCase):
+    '''
+    Processes and threads are both counted for the cgroup itself, whatever
+    the listing leaves out
+    '''
+    def setUp(self):
+        self.root, mounts = make_tree(['pids'], {
+            '/': {'cgroup.procs': tasks(1), 'tasks': tasks(1)},
+            '/a': pids_cgroup(1, 2, 44),
+            '/a/b': pids_cgroup(1, 2, 2),
+            '/a/z': pids_cgroup(1, 40, 40),
+        })
+        cgroup_top.CGROUP_MOUNTPOINTS.clear()
+        cgroup_top.CGROUP_DISCOVERY.clear()
+        cgroup_top.init(mounts)
+        cgroup_top.CONFIGURATION['columns'] = ['processes']
+        cgroup_top.rebuild_columns()
+        self.measures = {'data': defaultdict(dict), 'global': {'total_cpu': 1, 'total_memory': 1 << 30}}
+
+    def tearDown(self):
+        cgroup_top.CONFIGURATION['search_regex'] = None
+        cgroup_top.CONFIGURATION['hide_self'] = False
+        cgroup_top.CONFIGURATION['self'] = set()
+        cgroup_top.CGROUP_DISCOVERY.clear()
+        remove_tree(self.root)
+
+    def lines(self):
+        # First refresh discovers the hierarchy
+        for _ in range(2):
+            cgroup_top.collect(self.measures)
+        results = cgroup_top.built_statistics(self.measures, cgroup_top.CONFIGURATION)
+        cgroup_top.rollup(results)
+        return dict((line['cgroup'], line) for line in results)
+
+    def test_all_listed(self):
+        lines = self.lines()
+        self.assertEqual(lines['/a']['cur_tasks'], 2)
+        self.assertEqual(lines['/a']['tree_tasks'], 44)
+        self.assertEqual(lines['/a']['_rollup']['cur_tasks'], 44)
+        self.assertEqual(lines['/a']['_rollup']['cur_procs'], 3)
+
+    def test_child_filtered_by_search(self):
+        cgroup_top.CONFIGURATION['search_regex'] = re.compile('b')
+        lines = self.lines()
+        self.assertNotIn('/a/z', lines)
+        self.assertEqual(lines['/a']['cur_procs'], 1)
+        self.assertEqual(lines['/a']['cur_tasks'], 2)
+        self.assertEqual(lines['/a']['_rollup']['cur_procs'], 2)
+        self.assertEqual(lines['/a']['_rollup']['cur_tasks'], 4)
+
+    def test_child_hidden_as_self(self):
+        cgroup_top.CONFIGURATION['hide_self'] = True
+        cgroup_top.CONFIGURATION['self'] = set(['/a/z'])
+        lines = self.lines()
+        self.assertNotIn('/a/z', lines)
+        self.assertEqual(lines['/a']['cur_tasks'], 2)
+
+if __name__ == '__main__':
+    unittest.main()